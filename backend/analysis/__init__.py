@@ -4,12 +4,13 @@ Contains query analysis, execution plan analysis, and optimization heuristics.
 """
 
 from .core import analyze_queries, identify_hot_queries, calculate_performance_metrics
-from .explain import analyze_execution_plan, extract_plan_metrics
+from .explain import analyze_execution_plan, analyze_plan_tree, extract_plan_metrics
 
 __all__ = [
     'analyze_queries',
     'identify_hot_queries', 
     'calculate_performance_metrics',
     'analyze_execution_plan',
+    'analyze_plan_tree',
     'extract_plan_metrics'
 ] 
\ No newline at end of file
@@ -3,9 +3,12 @@ Core analysis module for OptiSchema backend.
 Handles query fingerprinting, hot query identification, and basic heuristics.
 """
 
+import heapq
 import logging
 import hashlib
+from operator import attrgetter
 import re
+from functools import lru_cache
 from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
 
@@ -15,9 +18,11 @@ from collector import get_metrics_cache
 logger = logging.getLogger(__name__)
 
 
+@lru_cache(maxsize=4096)
 def fingerprint_query(query_text: str) -> str:
     """
     Create a fingerprint for a query by normalizing whitespace and removing literals.
+    Results are memoized since the same query texts are fingerprinted repeatedly.
     
     Args:
         query_text: The raw SQL query text
@@ -93,7 +98,8 @@ def identify_hot_queries(metrics: List[QueryMetrics], limit: int = 10) -> List[H
         # Calculate percentage of total database time
         percentage = (total_time / total_db_time * 100) if total_db_time > 0 else 0
         
-        hot_query = HotQuery(
+        # Aggregates of already-built metrics, so skip pydantic validation
+        hot_query = HotQuery.model_construct(
             query_hash=hashlib.md5(fingerprint.encode()).hexdigest(),
             query_text=group_metrics[0].query_text,  # Use first query as representative
             total_time=total_time,
@@ -103,10 +109,8 @@ def identify_hot_queries(metrics: List[QueryMetrics], limit: int = 10) -> List[H
         )
         hot_queries.append(hot_query)
     
-    # Sort by total execution time (descending)
-    hot_queries.sort(key=lambda x: x.total_time, reverse=True)
-    
-    return hot_queries[:limit]
+    # Top entries by total execution time (descending), without a full sort
+    return heapq.nlargest(limit, hot_queries, key=attrgetter('total_time'))
 
 
 def calculate_performance_metrics(metrics: List[QueryMetrics]) -> MetricsSummary:
@@ -143,7 +147,7 @@ def calculate_performance_metrics(metrics: List[QueryMetrics]) -> MetricsSummary
     # Convert to HotQuery format if needed
     slowest_hot = None
     if slowest_query:
-        slowest_hot = HotQuery(
+        slowest_hot = HotQuery.model_construct(
             query_hash=slowest_query.query_hash,
             query_text=slowest_query.query_text,
             total_time=slowest_query.total_time,
@@ -154,7 +158,7 @@ def calculate_performance_metrics(metrics: List[QueryMetrics]) -> MetricsSummary
     
     most_called_hot = None
     if most_called_query:
-        most_called_hot = HotQuery(
+        most_called_hot = HotQuery.model_construct(
             query_hash=most_called_query.query_hash,
             query_text=most_called_query.query_text,
             total_time=most_called_query.total_time,
@@ -4,7 +4,8 @@ Handles EXPLAIN plan execution, parsing, and performance bottleneck detection.
 """
 
 import logging
-import json
+import orjson
+from collections import Counter, deque
 from typing import Dict, Any, List, Optional, Tuple
 from datetime import datetime
 
@@ -29,37 +30,39 @@ async def execute_explain_plan(query_text: str) -> Optional[Dict[str, Any]]:
         explain_query = f"EXPLAIN (FORMAT JSON, ANALYZE, BUFFERS) {query_text}"
         
         pool = await get_pool()
-        async with pool.acquire() as conn:
-            # Execute the explain query
-            result = await conn.fetchval(explain_query)
-            
-            if result:
-                # Parse the JSON result
-                if isinstance(result, str):
-                    plan_data = json.loads(result)
-                else:
-                    plan_data = result
-                
-                logger.info(f"Successfully generated execution plan for query")
-                return plan_data
+        # Execute the explain query (the connection is released before parsing)
+        result = await pool.fetchval(explain_query)
+        
+        if result:
+            # Parse the JSON result
+            if isinstance(result, str):
+                plan_data = orjson.loads(result)
             else:
-                logger.warning("EXPLAIN query returned no results")
-                return None
+                plan_data = result
+            
+            logger.info(f"Successfully generated execution plan for query")
+            return plan_data
+        else:
+            logger.warning("EXPLAIN query returned no results")
+            return None
                 
     except Exception as e:
         logger.error(f"Failed to execute EXPLAIN plan: {e}")
         return None
 
 
-def extract_plan_metrics(plan_json: Dict[str, Any]) -> Dict[str, Any]:
+def analyze_plan_tree(plan_json: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Extract key performance metrics from an execution plan.
+    Analyze an execution plan in a single traversal.
+    
+    Builds the node tree, accumulates totals, detects bottlenecks and
+    collects summary insights in one sweep over the plan nodes.
     
     Args:
         plan_json: Raw execution plan JSON
         
     Returns:
-        Extracted metrics and analysis
+        Extracted metrics, bottlenecks and summary insights
     """
     if not plan_json:
         return {}
@@ -86,7 +89,10 @@ def extract_plan_metrics(plan_json: Dict[str, Any]) -> Dict[str, Any]:
         'temp_read_blocks': 0,
         'temp_written_blocks': 0,
         'nodes': [],
-        'bottlenecks': []
+        'node_type_counts': Counter(),  # every node in the tree, not just top-level
+        'bottlenecks': [],
+        'key_insights': [],
+        'recommendations': []
     }
     
     # Extract timing information
@@ -109,137 +115,214 @@ def extract_plan_metrics(plan_json: Dict[str, Any]) -> Dict[str, Any]:
     if 'Temp Written Blocks' in plan:
         metrics['temp_written_blocks'] = int(plan['Temp Written Blocks'])
     
-    # Analyze plan nodes
-    def analyze_node(node: Dict[str, Any], depth: int = 0) -> Dict[str, Any]:
-        """Recursively analyze plan nodes."""
-        node_info = {
-            'node_type': node.get('Node Type', 'Unknown'),
-            'cost': float(node.get('Total Cost', 0)),
-            'rows': int(node.get('Plan Rows', 0)),
-            'width': int(node.get('Plan Width', 0)),
-            'actual_time': float(node.get('Actual Time', 0)),
-            'actual_rows': int(node.get('Actual Rows', 0)),
-            'loops': int(node.get('Loops', 1)),
-            'depth': depth,
-            'relation_name': node.get('Relation Name', ''),
-            'index_name': node.get('Index Name', ''),
-            'scan_direction': node.get('Scan Direction', ''),
-            'filter': node.get('Filter', ''),
-            'join_type': node.get('Join Type', ''),
-            'hash_condition': node.get('Hash Cond', ''),
-            'merge_condition': node.get('Merge Cond', ''),
-            'sort_key': node.get('Sort Key', []),
-            'group_key': node.get('Group Key', []),
-            'children': []
-        }
+    # Analyze plan nodes iteratively in pre-order (children pushed in reverse
+    # so they are visited, and attached to their parent, in plan order)
+    if 'Plan' in plan:
+        total_cost = 0.0
+        total_rows = 0
+        bottlenecks = metrics['bottlenecks']
+        insights = metrics['key_insights']
+        recommendations = metrics['recommendations']
+        node_type_counts = metrics['node_type_counts']
+        stack = deque([(plan['Plan'], 0, None)])
+        pop = stack.pop
+        push = stack.append
+        get_checker = _CHECKERS.get
+        while stack:
+            node, depth, parent = pop()
+            get = node.get
+            node_info = {
+                'node_type': get('Node Type', 'Unknown'),
+                'cost': float(get('Total Cost', 0)),
+                'rows': int(get('Plan Rows', 0)),
+                'width': int(get('Plan Width', 0)),
+                'actual_time': float(get('Actual Time', 0)),
+                'actual_rows': int(get('Actual Rows', 0)),
+                'loops': int(get('Loops', 1)),
+                'depth': depth,
+                'relation_name': get('Relation Name', ''),
+                'index_name': get('Index Name', ''),
+                'scan_direction': get('Scan Direction', ''),
+                'filter': get('Filter', ''),
+                'join_type': get('Join Type', ''),
+                'hash_condition': get('Hash Cond', ''),
+                'merge_condition': get('Merge Cond', ''),
+                'sort_key': get('Sort Key', []),
+                'group_key': get('Group Key', []),
+                'children': []
+            }
+            
+            total_cost += node_info['cost']
+            total_rows += node_info['actual_rows']
+            node_type_counts[node_info['node_type']] += 1
+            get_checker(node_info['node_type'], _noop)(node_info, bottlenecks)
+            
+            if parent is None:
+                metrics['nodes'].append(node_info)
+                # Summary insights cover the top-level plan nodes
+                collect_node_insights(node_info, insights, recommendations)
+            else:
+                parent['children'].append(node_info)
+            
+            children = get('Plans')
+            if children:
+                for child in reversed(children):
+                    push((child, depth + 1, node_info))
         
         # Update total metrics
-        metrics['total_cost'] += node_info['cost']
-        metrics['total_rows'] += node_info['actual_rows']
-        
-        # Analyze children
-        if 'Plans' in node:
-            for child in node['Plans']:
-                child_info = analyze_node(child, depth + 1)
-                node_info['children'].append(child_info)
-        
-        return node_info
-    
-    # Start analysis from the root plan
-    if 'Plan' in plan:
-        root_node = analyze_node(plan['Plan'])
-        metrics['nodes'].append(root_node)
-    
-    # Detect bottlenecks
-    bottlenecks = detect_plan_bottlenecks(metrics['nodes'])
-    metrics['bottlenecks'] = bottlenecks
+        metrics['total_cost'] += total_cost
+        metrics['total_rows'] += total_rows
     
     return metrics
 
 
-def detect_plan_bottlenecks(nodes: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+def extract_plan_metrics(plan_json: Dict[str, Any]) -> Dict[str, Any]:
     """
-    Detect performance bottlenecks in execution plan nodes.
+    Extract key performance metrics from an execution plan.
     
     Args:
-        nodes: List of analyzed plan nodes
+        plan_json: Raw execution plan JSON
         
     Returns:
-        List of detected bottlenecks
+        Extracted metrics and analysis
     """
-    bottlenecks = []
+    return analyze_plan_tree(plan_json)
+
+
+def _check_seq_scan(node: Dict[str, Any], bottlenecks: List[Dict[str, Any]]):
+    """Check a Seq Scan node for large scans and missing indexes."""
+    actual_rows = node['actual_rows']
     
-    def check_node_bottlenecks(node: Dict[str, Any]):
-        """Check individual node for bottlenecks."""
-        node_type = node['node_type']
-        actual_time = node['actual_time']
-        actual_rows = node['actual_rows']
-        loops = node['loops']
-        
-        # Sequential Scan on large tables
-        if node_type == 'Seq Scan' and actual_rows > 1000:
-            bottlenecks.append({
-                'type': 'sequential_scan',
-                'severity': 'high' if actual_rows > 10000 else 'medium',
-                'node_type': node_type,
-                'description': f'Sequential scan on {node.get("relation_name", "table")} returning {actual_rows} rows',
-                'recommendation': 'Consider adding an index on the WHERE clause columns',
-                'impact': 'High - scans entire table'
-            })
-        
-        # Sort operations on large datasets
-        if node_type == 'Sort' and actual_rows > 1000:
-            bottlenecks.append({
-                'type': 'large_sort',
-                'severity': 'medium',
-                'node_type': node_type,
-                'description': f'Sort operation on {actual_rows} rows',
-                'recommendation': 'Consider adding an index with the same sort order',
-                'impact': 'Medium - requires temporary storage'
-            })
-        
-        # Hash operations
-        if node_type == 'Hash' and actual_rows > 5000:
-            bottlenecks.append({
-                'type': 'large_hash',
-                'severity': 'medium',
-                'node_type': node_type,
-                'description': f'Hash operation on {actual_rows} rows',
-                'recommendation': 'Consider using nested loop joins for smaller datasets',
-                'impact': 'Medium - requires building hash table in memory'
-            })
-        
-        # Nested Loop with large outer relation
-        if node_type == 'Nested Loop' and actual_rows > 10000:
-            bottlenecks.append({
-                'type': 'large_nested_loop',
-                'severity': 'high',
-                'node_type': node_type,
-                'description': f'Nested loop join with {actual_rows} rows',
-                'recommendation': 'Consider using hash or merge joins for large datasets',
-                'impact': 'High - quadratic complexity'
-            })
-        
-        # Check for missing indexes (Index Scan vs Seq Scan)
-        if node_type == 'Seq Scan' and node.get('filter'):
-            bottlenecks.append({
-                'type': 'missing_index',
-                'severity': 'high',
-                'node_type': node_type,
-                'description': f'Sequential scan with filter: {node.get("filter", "")}',
-                'recommendation': 'Add index on filtered columns',
-                'impact': 'High - scans entire table instead of using index'
-            })
-        
-        # Recursively check children
-        for child in node.get('children', []):
-            check_node_bottlenecks(child)
+    # Sequential Scan on large tables
+    if actual_rows > 1000:
+        bottlenecks.append({
+            'type': 'sequential_scan',
+            'severity': 'high' if actual_rows > 10000 else 'medium',
+            'node_type': node['node_type'],
+            'description': f'Sequential scan on {node.get("relation_name", "table")} returning {actual_rows} rows',
+            'recommendation': 'Consider adding an index on the WHERE clause columns',
+            'impact': 'High - scans entire table'
+        })
     
-    # Check all nodes
-    for node in nodes:
-        check_node_bottlenecks(node)
+    # Check for missing indexes (Index Scan vs Seq Scan)
+    if node.get('filter'):
+        bottlenecks.append({
+            'type': 'missing_index',
+            'severity': 'high',
+            'node_type': node['node_type'],
+            'description': f'Sequential scan with filter: {node.get("filter", "")}',
+            'recommendation': 'Add index on filtered columns',
+            'impact': 'High - scans entire table instead of using index'
+        })
+
+
+def _check_sort(node: Dict[str, Any], bottlenecks: List[Dict[str, Any]]):
+    """Check a Sort node for sorts over large datasets."""
+    actual_rows = node['actual_rows']
+    if actual_rows > 1000:
+        bottlenecks.append({
+            'type': 'large_sort',
+            'severity': 'medium',
+            'node_type': node['node_type'],
+            'description': f'Sort operation on {actual_rows} rows',
+            'recommendation': 'Consider adding an index with the same sort order',
+            'impact': 'Medium - requires temporary storage'
+        })
+
+
+def _check_hash(node: Dict[str, Any], bottlenecks: List[Dict[str, Any]]):
+    """Check a Hash node for large hash tables."""
+    actual_rows = node['actual_rows']
+    if actual_rows > 5000:
+        bottlenecks.append({
+            'type': 'large_hash',
+            'severity': 'medium',
+            'node_type': node['node_type'],
+            'description': f'Hash operation on {actual_rows} rows',
+            'recommendation': 'Consider using nested loop joins for smaller datasets',
+            'impact': 'Medium - requires building hash table in memory'
+        })
+
+
+def _check_nested_loop(node: Dict[str, Any], bottlenecks: List[Dict[str, Any]]):
+    """Check a Nested Loop node for large outer relations."""
+    actual_rows = node['actual_rows']
+    if actual_rows > 10000:
+        bottlenecks.append({
+            'type': 'large_nested_loop',
+            'severity': 'high',
+            'node_type': node['node_type'],
+            'description': f'Nested loop join with {actual_rows} rows',
+            'recommendation': 'Consider using hash or merge joins for large datasets',
+            'impact': 'High - quadratic complexity'
+        })
+
+
+def _noop(node: Dict[str, Any], bottlenecks: List[Dict[str, Any]]):
+    """Checker for node types without bottleneck rules."""
+
+
+# Bottleneck checkers keyed by plan node type
+_CHECKERS = {
+    'Seq Scan': _check_seq_scan,
+    'Sort': _check_sort,
+    'Hash': _check_hash,
+    'Nested Loop': _check_nested_loop,
+}
+
+
+def collect_node_insights(node: Dict[str, Any], insights: List[str], recommendations: List[str]):
+    """
+    Collect human-readable summary insights for a single analyzed plan node.
+    
+    Args:
+        node: Analyzed plan node
+        insights: List that key insights are appended to
+        recommendations: List that summary recommendations are appended to
+    """
+    node_type = node.get('node_type', '')
+    actual_time = node.get('actual_time', 0)
+    actual_rows = node.get('actual_rows', 0)
+    
+    if node_type == 'Seq Scan' and actual_rows > 1000:
+        insights.append(f"Large sequential scan: {actual_rows} rows")
+        recommendations.append("Consider adding indexes on WHERE clause columns")
+    
+    if node_type == 'Sort' and actual_rows > 1000:
+        insights.append(f"Large sort operation: {actual_rows} rows")
+        recommendations.append("Consider adding indexes with appropriate sort order")
+    
+    if actual_time > 100:  # > 100ms
+        insights.append(f"Slow {node_type} operation: {actual_time:.2f}ms")
+
+
+def build_execution_plan(plan_json: Any) -> ExecutionPlan:
+    """
+    Build an ExecutionPlan from raw EXPLAIN JSON.
     
-    return bottlenecks
+    The plan and the node trees derived from it can be large, so the model
+    is constructed without validation; every field comes from the traversal.
+    
+    Args:
+        plan_json: Raw EXPLAIN (FORMAT JSON) output
+        
+    Returns:
+        ExecutionPlan object with analysis results
+    """
+    # Extract metrics, bottlenecks and insights in one pass
+    metrics = analyze_plan_tree(plan_json)
+    
+    return ExecutionPlan.model_construct(
+        plan_json=plan_json,
+        total_cost=metrics.get('total_cost'),
+        total_time=metrics.get('total_time'),
+        planning_time=metrics.get('planning_time'),
+        execution_time=metrics.get('execution_time'),
+        nodes=metrics.get('nodes', []),
+        bottlenecks=metrics.get('bottlenecks', []),
+        key_insights=metrics.get('key_insights', []),
+        recommendations=metrics.get('recommendations', [])
+    )
 
 
 async def analyze_execution_plan(query_text: str) -> Optional[ExecutionPlan]:
@@ -259,20 +342,9 @@ async def analyze_execution_plan(query_text: str) -> Optional[ExecutionPlan]:
             logger.warning("Failed to generate execution plan")
             return None
         
-        # Extract metrics from plan
-        metrics = extract_plan_metrics(plan_json)
-        
-        # Create ExecutionPlan object
-        execution_plan = ExecutionPlan(
-            plan_json=plan_json,
-            total_cost=metrics.get('total_cost'),
-            total_time=metrics.get('total_time'),
-            planning_time=metrics.get('planning_time'),
-            execution_time=metrics.get('execution_time'),
-            nodes=metrics.get('nodes', [])
-        )
+        execution_plan = build_execution_plan(plan_json)
         
-        logger.info(f"Execution plan analysis complete: {len(metrics.get('bottlenecks', []))} bottlenecks detected")
+        logger.info(f"Execution plan analysis complete: {len(execution_plan.bottlenecks)} bottlenecks detected")
         
         return execution_plan
         
@@ -301,8 +373,9 @@ def get_plan_summary(execution_plan: ExecutionPlan) -> Dict[str, Any]:
         'execution_time': execution_plan.execution_time,
         'node_count': len(execution_plan.nodes),
         'performance_rating': 'good',
-        'key_insights': [],
-        'recommendations': []
+        # Insights were collected during the plan traversal
+        'key_insights': list(execution_plan.key_insights),
+        'recommendations': list(execution_plan.recommendations)
     }
     
     # Analyze performance rating
@@ -311,21 +384,4 @@ def get_plan_summary(execution_plan: ExecutionPlan) -> Dict[str, Any]:
     elif execution_plan.total_time and execution_plan.total_time > 100:  # > 100ms
         summary['performance_rating'] = 'fair'
     
-    # Extract insights from nodes
-    for node in execution_plan.nodes:
-        node_type = node.get('node_type', '')
-        actual_time = node.get('actual_time', 0)
-        actual_rows = node.get('actual_rows', 0)
-        
-        if node_type == 'Seq Scan' and actual_rows > 1000:
-            summary['key_insights'].append(f"Large sequential scan: {actual_rows} rows")
-            summary['recommendations'].append("Consider adding indexes on WHERE clause columns")
-        
-        if node_type == 'Sort' and actual_rows > 1000:
-            summary['key_insights'].append(f"Large sort operation: {actual_rows} rows")
-            summary['recommendations'].append("Consider adding indexes with appropriate sort order")
-        
-        if actual_time > 100:  # > 100ms
-            summary['key_insights'].append(f"Slow {node_type} operation: {actual_time:.2f}ms")
-    
-    return summary 
\ No newline at end of file
+    return summary
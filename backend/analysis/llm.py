@@ -3,24 +3,35 @@ Multi-model LLM integration for OptiSchema backend.
 Supports Gemini (Google) and DeepSeek for query analysis and recommendations.
 """
 
+import asyncio
 import os
 import logging
 import json
+import re
 import aiohttp
-from typing import Dict, Any, Optional
-from config import settings
+import orjson
+from typing import Dict, Any, Optional, Callable, Awaitable, AsyncIterator, Tuple
+from config import get_settings
 from analysis.core import fingerprint_query
-from cache import make_cache_key, get_cache, set_cache
+from cache import make_cache_key, aget_cache, aset_cache
+from utils import query_hash
 
 logger = logging.getLogger(__name__)
 
-# Model configuration
-GEMINI_API_KEY = settings.gemini_api_key
-DEEPSEEK_API_KEY = settings.deepseek_api_key
-ACTIVE_MODEL = settings.llm_provider
+# Model configuration (read from settings on use, so importing needs no environment)
+def _active_model() -> str:
+    """The configured LLM provider (LLM_PROVIDER)."""
+    return get_settings().llm_provider
 
-# Prompt templates
-EXPLAIN_PLAN_PROMPT = """
+# Shared HTTP session so LLM calls reuse TCP/TLS connections
+_session: Optional[aiohttp.ClientSession] = None
+
+# In-flight LLM requests keyed by cache key, used to collapse cache-miss stampedes
+_inflight: Dict[str, asyncio.Task] = {}
+
+# Prompt templates (callables taking already-serialized JSON/SQL strings)
+def explain_plan_prompt(plan_json: str) -> str:
+    return f"""
 You are a PostgreSQL performance expert. Given the following execution plan (in JSON), explain the main performance bottlenecks and suggest optimizations in clear, actionable language for a database engineer.
 
 **Format your response in Markdown:**
@@ -34,7 +45,8 @@ Execution Plan JSON:
 {plan_json}
 """
 
-REWRITE_QUERY_PROMPT = """
+def rewrite_query_prompt(sql: str) -> str:
+    return f"""
 You are an expert SQL query optimizer. Given the following SQL query, rewrite it for better performance on PostgreSQL.
 
 **Requirements:**
@@ -47,7 +59,8 @@ Original Query:
 {sql}
 """
 
-RECOMMENDATION_PROMPT = """
+def recommendation_prompt(query_data: str) -> str:
+    return f"""
 You are a PostgreSQL tuning assistant. Given the following query metrics and analysis, generate a specific, actionable recommendation to improve performance. 
 
 **Format your response in Markdown:**
@@ -72,12 +85,60 @@ Query Data:
 4. For SQL fixes, provide clean SQL without markdown formatting
 """
 
-async def call_gemini_api(prompt: str, max_tokens: int = 512) -> str:
-    """Call Gemini API."""
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent"
+# Matches "SQL: ..." lines in LLM recommendation output (last one wins)
+_SQL_LINE_RE = re.compile(r'^[^\S\n]*SQL:(.*)$', re.IGNORECASE | re.MULTILINE)
+
+# Plans with no bottlenecks that finish under this many ms skip the LLM entirely
+NO_ISSUES_MAX_EXECUTION_MS = 50
+NO_ISSUES_RECOMMENDATION = {
+    "title": "No optimization needed",
+    "description": "The execution plan shows no bottlenecks and the query runs quickly. No changes are recommended.",
+    "sql_fix": None
+}
+
+def _llm_cache_key(query_text: str, analysis_type: str, variant: Optional[str] = None) -> str:
+    """
+    Cache key for an LLM result about a query.
+    Structurally identical queries share a key (hash of the fingerprint);
+    variant separates results that also depend on other inputs.
+    """
+    if variant:
+        analysis_type = f"{analysis_type}:{variant}"
+    return make_cache_key(query_hash(fingerprint_query(query_text)), analysis_type)
+
+def _to_json(data: Any) -> str:
+    """Serialize prompt data as compact JSON (non-JSON types fall back to str)."""
+    return orjson.dumps(data, default=str).decode()
+
+async def _get_session() -> aiohttp.ClientSession:
+    """Get the shared LLM HTTP session, creating it on first use."""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=32, ttl_dns_cache=300, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=30)
+        )
+    return _session
+
+async def close_session():
+    """Close the shared LLM HTTP session."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash"
+DEEPSEEK_URL = "https://api.deepseek.com/v1/chat/completions"
+
+# Streaming responses can legitimately outlive the session's total timeout,
+# so only bound the gap between chunks
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_read=30)
+
+def _gemini_request(prompt: str, max_tokens: int) -> Tuple[Dict[str, str], Dict[str, Any]]:
+    """Build Gemini request headers and body."""
     headers = {
         "Content-Type": "application/json",
-        "X-goog-api-key": GEMINI_API_KEY
+        "X-goog-api-key": get_settings().gemini_api_key
     }
     data = {
         "contents": [{
@@ -88,22 +149,13 @@ async def call_gemini_api(prompt: str, max_tokens: int = 512) -> str:
             "temperature": 0.2
         }
     }
-    
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            if response.status == 200:
-                result = await response.json()
-                return result["candidates"][0]["content"]["parts"][0]["text"].strip()
-            else:
-                error_text = await response.text()
-                raise Exception(f"Gemini API error: {response.status} - {error_text}")
+    return headers, data
 
-async def call_deepseek_api(prompt: str, max_tokens: int = 512) -> str:
-    """Call DeepSeek API."""
-    url = "https://api.deepseek.com/v1/chat/completions"
+def _deepseek_request(prompt: str, max_tokens: int, stream: bool = False) -> Tuple[Dict[str, str], Dict[str, Any]]:
+    """Build DeepSeek request headers and body."""
     headers = {
         "Content-Type": "application/json",
-        "Authorization": f"Bearer {DEEPSEEK_API_KEY}"
+        "Authorization": f"Bearer {get_settings().deepseek_api_key}"
     }
     data = {
         "model": "deepseek-chat",
@@ -111,118 +163,255 @@ async def call_deepseek_api(prompt: str, max_tokens: int = 512) -> str:
         "max_tokens": max_tokens,
         "temperature": 0.2
     }
+    if stream:
+        data["stream"] = True
+    return headers, data
+
+async def call_gemini_api(prompt: str, max_tokens: int = 512) -> str:
+    """Call Gemini API."""
+    url = f"{GEMINI_URL}:generateContent"
+    headers, data = _gemini_request(prompt, max_tokens)
+    
+    session = await _get_session()
+    async with session.post(url, headers=headers, json=data) as response:
+        if response.status == 200:
+            result = await response.json()
+            return result["candidates"][0]["content"]["parts"][0]["text"].strip()
+        else:
+            error_text = await response.text()
+            raise Exception(f"Gemini API error: {response.status} - {error_text}")
+
+async def call_deepseek_api(prompt: str, max_tokens: int = 512) -> str:
+    """Call DeepSeek API."""
+    headers, data = _deepseek_request(prompt, max_tokens)
+    
+    session = await _get_session()
+    async with session.post(DEEPSEEK_URL, headers=headers, json=data) as response:
+        if response.status == 200:
+            result = await response.json()
+            return result["choices"][0]["message"]["content"].strip()
+        else:
+            error_text = await response.text()
+            raise Exception(f"DeepSeek API error: {response.status} - {error_text}")
+
+async def _iter_sse_data(response: aiohttp.ClientResponse) -> AsyncIterator[Dict[str, Any]]:
+    """Yield decoded JSON payloads from a server-sent events response."""
+    async for raw_line in response.content:
+        line = raw_line.strip()
+        if not line.startswith(b"data:"):
+            continue
+        payload = line[5:].strip()
+        if payload == b"[DONE]":
+            break
+        yield orjson.loads(payload)
+
+async def stream_gemini_api(prompt: str, max_tokens: int = 512) -> AsyncIterator[str]:
+    """Stream Gemini API output chunk by chunk."""
+    url = f"{GEMINI_URL}:streamGenerateContent?alt=sse"
+    headers, data = _gemini_request(prompt, max_tokens)
+    
+    session = await _get_session()
+    async with session.post(url, headers=headers, json=data, timeout=STREAM_TIMEOUT) as response:
+        if response.status != 200:
+            error_text = await response.text()
+            raise Exception(f"Gemini API error: {response.status} - {error_text}")
+        async for event in _iter_sse_data(response):
+            for candidate in event.get("candidates", []):
+                for part in candidate.get("content", {}).get("parts", []):
+                    text = part.get("text")
+                    if text:
+                        yield text
+
+async def stream_deepseek_api(prompt: str, max_tokens: int = 512) -> AsyncIterator[str]:
+    """Stream DeepSeek API output chunk by chunk."""
+    headers, data = _deepseek_request(prompt, max_tokens, stream=True)
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers, json=data) as response:
-            if response.status == 200:
-                result = await response.json()
-                return result["choices"][0]["message"]["content"].strip()
-            else:
-                error_text = await response.text()
-                raise Exception(f"DeepSeek API error: {response.status} - {error_text}")
+    session = await _get_session()
+    async with session.post(DEEPSEEK_URL, headers=headers, json=data, timeout=STREAM_TIMEOUT) as response:
+        if response.status != 200:
+            error_text = await response.text()
+            raise Exception(f"DeepSeek API error: {response.status} - {error_text}")
+        async for event in _iter_sse_data(response):
+            for choice in event.get("choices", []):
+                text = choice.get("delta", {}).get("content")
+                if text:
+                    yield text
 
 async def call_llm_api(prompt: str, max_tokens: int = 512) -> str:
     """Call the active LLM API."""
-    if ACTIVE_MODEL == "gemini":
+    active_model = _active_model()
+    if active_model == "gemini":
         return await call_gemini_api(prompt, max_tokens)
-    elif ACTIVE_MODEL == "deepseek":
+    elif active_model == "deepseek":
         return await call_deepseek_api(prompt, max_tokens)
     else:
-        raise ValueError(f"Unknown model: {ACTIVE_MODEL}")
+        raise ValueError(f"Unknown model: {active_model}")
+
+def stream_llm_api(prompt: str, max_tokens: int = 512) -> AsyncIterator[str]:
+    """Stream output from the active LLM API as it is generated."""
+    active_model = _active_model()
+    if active_model == "gemini":
+        return stream_gemini_api(prompt, max_tokens)
+    elif active_model == "deepseek":
+        return stream_deepseek_api(prompt, max_tokens)
+    else:
+        raise ValueError(f"Unknown model: {active_model}")
 
 # Core AI functions
+async def _coalesce(cache_key: Optional[str], produce: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Run produce() at most once per cache key at a time.
+    Concurrent callers for the same key await the in-flight result instead
+    of issuing their own upstream LLM request.
+    """
+    if cache_key is None:
+        return await produce()
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(produce())
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda _: _inflight.pop(cache_key, None))
+    # Shield so one cancelled caller doesn't cancel the shared request
+    return await asyncio.shield(task)
+
 async def explain_plan(plan_json: Dict[str, Any], query_text: Optional[str] = None) -> str:
     """
     Use LLM to explain a PostgreSQL execution plan.
     Returns a human-readable explanation and suggestions.
     Caches by query fingerprint + 'explain_plan'.
     """
-    fingerprint = fingerprint_query(query_text) if query_text else None
-    cache_key = make_cache_key(fingerprint, 'explain_plan') if fingerprint else None
+    cache_key = _llm_cache_key(query_text, 'explain_plan') if query_text else None
     if cache_key:
-        cached = get_cache(cache_key)
+        cached = await aget_cache(cache_key)
         if cached:
             logger.info("Cache hit for plan explanation.")
             return cached
-    prompt = EXPLAIN_PLAN_PROMPT.format(plan_json=plan_json)
+
+    async def produce() -> str:
+        prompt = explain_plan_prompt(_to_json(plan_json))
+        try:
+            explanation = await call_llm_api(prompt, max_tokens=512)
+            if cache_key:
+                await aset_cache(cache_key, explanation)
+            logger.info(f"{_active_model().title()} plan explanation generated.")
+            return explanation
+        except Exception as e:
+            logger.error(f"{_active_model().title()} plan explanation failed: {e}")
+            return f"[{_active_model().title()} explanation unavailable]"
+
+    return await _coalesce(cache_key, produce)
+
+async def stream_explain_plan(plan_json: Dict[str, Any], query_text: Optional[str] = None) -> AsyncIterator[str]:
+    """
+    Streaming variant of explain_plan.
+    Yields the explanation as the LLM generates it so callers (e.g. the
+    WebSocket layer) can forward text before generation completes.
+    The full explanation is cached under the same key as explain_plan.
+    """
+    cache_key = _llm_cache_key(query_text, 'explain_plan') if query_text else None
+    if cache_key:
+        cached = await aget_cache(cache_key)
+        if cached:
+            logger.info("Cache hit for plan explanation.")
+            yield cached
+            return
+    
+    prompt = explain_plan_prompt(_to_json(plan_json))
+    chunks = []
     try:
-        explanation = await call_llm_api(prompt, max_tokens=512)
-        if cache_key:
-            set_cache(cache_key, explanation)
-        logger.info(f"{ACTIVE_MODEL.title()} plan explanation generated.")
-        return explanation
+        async for chunk in stream_llm_api(prompt, max_tokens=512):
+            chunks.append(chunk)
+            yield chunk
     except Exception as e:
-        logger.error(f"{ACTIVE_MODEL.title()} plan explanation failed: {e}")
-        return f"[{ACTIVE_MODEL.title()} explanation unavailable]"
+        logger.error(f"{_active_model().title()} plan explanation failed: {e}")
+        if not chunks:
+            yield f"[{_active_model().title()} explanation unavailable]"
+        return
+    
+    explanation = "".join(chunks).strip()
+    if cache_key and explanation:
+        await aset_cache(cache_key, explanation)
+    logger.info(f"{_active_model().title()} plan explanation streamed.")
 
 async def rewrite_query(sql: str) -> str:
     """
     Use LLM to rewrite a SQL query for better performance.
     Returns the optimized SQL. Caches by query fingerprint + 'rewrite_query'.
     """
-    fingerprint = fingerprint_query(sql)
-    cache_key = make_cache_key(fingerprint, 'rewrite_query')
-    cached = get_cache(cache_key)
+    cache_key = _llm_cache_key(sql, 'rewrite_query')
+    cached = await aget_cache(cache_key)
     if cached:
         logger.info("Cache hit for query rewrite.")
         return cached
-    prompt = REWRITE_QUERY_PROMPT.format(sql=sql)
-    try:
-        optimized_sql = await call_llm_api(prompt, max_tokens=256)
-        set_cache(cache_key, optimized_sql)
-        logger.info(f"{ACTIVE_MODEL.title()} query rewrite generated.")
-        return optimized_sql
-    except Exception as e:
-        logger.error(f"{ACTIVE_MODEL.title()} query rewrite failed: {e}")
-        return sql
+
+    async def produce() -> str:
+        prompt = rewrite_query_prompt(sql)
+        try:
+            optimized_sql = await call_llm_api(prompt, max_tokens=256)
+            await aset_cache(cache_key, optimized_sql)
+            logger.info(f"{_active_model().title()} query rewrite generated.")
+            return optimized_sql
+        except Exception as e:
+            logger.error(f"{_active_model().title()} query rewrite failed: {e}")
+            return sql
+
+    return await _coalesce(cache_key, produce)
 
 async def generate_recommendation(query_data: Dict[str, Any]) -> Dict[str, Any]:
     """
     Use LLM to generate a recommendation for a query.
     Returns a dict with title, description, and optional SQL fix.
-    Caches by query fingerprint + 'recommendation'.
+    Caches by query fingerprint + bottleneck type + 'recommendation'.
+    Returns a canned response without calling the LLM when the plan has
+    no bottlenecks and executes under NO_ISSUES_MAX_EXECUTION_MS.
     """
+    if query_data.get('bottlenecks') == [] and (query_data.get('execution_time') or 0) < NO_ISSUES_MAX_EXECUTION_MS:
+        logger.info("No plan bottlenecks, skipping LLM recommendation.")
+        return dict(NO_ISSUES_RECOMMENDATION)
+
     # Use query_text if present for fingerprinting
     query_text = query_data.get('query_text') or json.dumps(query_data)
-    fingerprint = fingerprint_query(query_text)
-    cache_key = make_cache_key(fingerprint, 'recommendation')
-    cached = get_cache(cache_key)
+    cache_key = _llm_cache_key(query_text, 'recommendation', query_data.get('bottleneck_type'))
+    cached = await aget_cache(cache_key)
     if cached:
         logger.info("Cache hit for recommendation.")
         try:
             return json.loads(cached)
         except Exception:
             pass
-    prompt = RECOMMENDATION_PROMPT.format(query_data=query_data)
-    try:
-        content = await call_llm_api(prompt, max_tokens=512)
-        
-        # Simple parsing: expect title, description, and SQL fix if present
-        lines = content.split('\n')
-        title = lines[0].strip() if lines else "Recommendation"
-        description = "\n".join(lines[1:]).strip() if len(lines) > 1 else ""
-        sql_fix = None
-        for line in lines:
-            if line.strip().upper().startswith("SQL:"):
-                sql_fix = line.split(":", 1)[-1].strip()
-        
-        # Clean up title - remove any markdown formatting
-        if title.startswith('#') or title.startswith('##'):
-            title = title.lstrip('#').strip()
-        
-        result = {
-            "title": title,
-            "description": description,
-            "sql_fix": sql_fix
-        }
-        
-        set_cache(cache_key, json.dumps(result))
-        logger.info(f"{ACTIVE_MODEL.title()} recommendation generated.")
-        return result
-    except Exception as e:
-        logger.error(f"{ACTIVE_MODEL.title()} recommendation failed: {e}")
-        return {
-            "title": f"[{ACTIVE_MODEL.title()} recommendation unavailable]",
-            "description": str(e),
-            "sql_fix": None
-        } 
\ No newline at end of file
+
+    async def produce() -> Dict[str, Any]:
+        prompt = recommendation_prompt(_to_json(query_data))
+        try:
+            content = await call_llm_api(prompt, max_tokens=512)
+            
+            # Simple parsing: expect title, description, and SQL fix if present
+            title, _, description = content.partition('\n')
+            title = title.strip()
+            description = description.strip()
+            sql_lines = _SQL_LINE_RE.findall(content)
+            sql_fix = sql_lines[-1].strip() if sql_lines else None
+            
+            # Clean up title - remove any markdown formatting
+            if title.startswith('#') or title.startswith('##'):
+                title = title.lstrip('#').strip()
+            
+            result = {
+                "title": title,
+                "description": description,
+                "sql_fix": sql_fix
+            }
+            
+            await aset_cache(cache_key, json.dumps(result))
+            logger.info(f"{_active_model().title()} recommendation generated.")
+            return result
+        except Exception as e:
+            logger.error(f"{_active_model().title()} recommendation failed: {e}")
+            return {
+                "title": f"[{_active_model().title()} recommendation unavailable]",
+                "description": str(e),
+                "sql_fix": None
+            }
+
+    # Hand each caller its own copy since coalesced callers share the result
+    return dict(await _coalesce(cache_key, produce))
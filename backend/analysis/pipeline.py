@@ -5,6 +5,8 @@ Coordinates query analysis and execution plan analysis on a scheduled basis.
 
 import asyncio
 import logging
+import orjson
+from collections import Counter
 from typing import List, Dict, Any, Optional
 from datetime import datetime, timedelta
 
@@ -12,16 +14,22 @@ from models import QueryMetrics, AnalysisResult, ExecutionPlan
 from collector import get_metrics_cache
 from .core import analyze_queries, identify_hot_queries, detect_basic_issues
 from .explain import analyze_execution_plan, get_plan_summary
-from config import settings
+from config import get_settings
 from recommendations import generate_recommendations
 from utils import calculate_performance_score
 
 logger = logging.getLogger(__name__)
 
-# Global cache for analysis results
-analysis_cache: List[AnalysisResult] = []
+# Global cache for analysis results, stored as JSON-ready dicts
+analysis_cache: List[Dict[str, Any]] = []
+# analysis_cache serialized once per pipeline run, served as-is by the API
+analysis_cache_json: bytes = b"[]"
 last_analysis_time: Optional[datetime] = None
-recommendations_cache: List[Any] = []
+# Latest recommendations as JSON-ready dicts (ids are strings), plus an id index
+recommendations_cache: List[Dict[str, Any]] = []
+recommendations_index: Dict[str, Dict[str, Any]] = {}
+# Recommendation counts by type, tallied once per pipeline run
+recommendations_type_counts: Counter = Counter()
 
 
 async def run_analysis_pipeline() -> Dict[str, Any]:
@@ -31,7 +39,7 @@ async def run_analysis_pipeline() -> Dict[str, Any]:
     Returns:
         Analysis results with performance insights and recommendations
     """
-    global analysis_cache, last_analysis_time, recommendations_cache
+    global analysis_cache, analysis_cache_json, last_analysis_time, recommendations_cache, recommendations_index, recommendations_type_counts
     
     try:
         logger.info("Starting analysis pipeline...")
@@ -58,8 +66,8 @@ async def run_analysis_pipeline() -> Dict[str, Any]:
                 # Detect basic issues
                 basic_issues = detect_basic_issues(hot_query.query_text)
                 
-                # Create analysis result
-                analysis_result = AnalysisResult(
+                # Create analysis result (all fields are server-computed, so skip validation)
+                analysis_result = AnalysisResult.model_construct(
                     query_hash=hot_query.query_hash,
                     query_text=hot_query.query_text,
                     execution_plan=execution_plan,
@@ -76,18 +84,23 @@ async def run_analysis_pipeline() -> Dict[str, Any]:
                 logger.error(f"Failed to analyze query {hot_query.query_hash}: {e}")
                 continue
         
-        # Update cache
-        analysis_cache = detailed_analyses
+        # Update cache (dumped once in JSON mode so readers only serialize)
+        detailed_dumps = [analysis.model_dump(mode='json') for analysis in detailed_analyses]
+        analysis_cache = detailed_dumps
+        analysis_cache_json = orjson.dumps(detailed_dumps)
         last_analysis_time = datetime.utcnow()
         
         # Generate recommendations for all analyses
-        recommendations_cache = await generate_recommendations(detailed_analyses)
+        recommendations = await generate_recommendations(detailed_analyses)
+        recommendations_cache = [rec.model_dump(mode='json') for rec in recommendations]
+        recommendations_index = {rec['id']: rec for rec in recommendations_cache}
+        recommendations_type_counts = Counter(rec.get('recommendation_type') for rec in recommendations_cache)
         
         # Prepare results
         results = {
             'core_analysis': core_analysis,
-            'detailed_analyses': [analysis.model_dump() for analysis in detailed_analyses],
-            'recommendations': [rec.model_dump() for rec in recommendations_cache],
+            'detailed_analyses': detailed_dumps,
+            'recommendations': recommendations_cache,
             'analysis_timestamp': last_analysis_time.isoformat(),
             'total_queries_analyzed': len(metrics),
             'hot_queries_analyzed': len(detailed_analyses)
@@ -218,7 +231,7 @@ async def start_analysis_scheduler():
             await run_analysis_pipeline()
             
             # Wait for next analysis interval
-            await asyncio.sleep(settings.analysis_interval)
+            await asyncio.sleep(get_settings().analysis_interval)
             
         except asyncio.CancelledError:
             logger.info("Analysis scheduler cancelled")
@@ -228,18 +241,31 @@ async def start_analysis_scheduler():
             await asyncio.sleep(60)  # Wait 1 minute before retrying
 
 
-def get_analysis_cache() -> List[AnalysisResult]:
-    """Get the latest analysis results from cache."""
+def get_analysis_cache() -> List[Dict[str, Any]]:
+    """Get the latest analysis results from cache as JSON-ready dictionaries."""
     return analysis_cache
 
 
+def get_analysis_cache_bytes() -> bytes:
+    """Get the latest analysis results as pre-serialized JSON."""
+    return analysis_cache_json
+
+
 def get_last_analysis_time() -> Optional[datetime]:
     """Get the timestamp of the last analysis run."""
     return last_analysis_time 
 
 
-def get_recommendations_cache() -> List[Any]:
-    """Get the latest recommendations from cache as dictionaries."""
-    if not recommendations_cache:
-        return []
-    return [rec.model_dump() if hasattr(rec, 'model_dump') else rec for rec in recommendations_cache] 
\ No newline at end of file
+def get_recommendations_cache() -> List[Dict[str, Any]]:
+    """Get the latest recommendations from cache as dictionaries (shared; do not mutate)."""
+    return recommendations_cache
+
+
+def get_recommendations_index() -> Dict[str, Dict[str, Any]]:
+    """Get the latest recommendations keyed by their string id (shared; do not mutate)."""
+    return recommendations_index 
+
+
+def get_recommendations_type_counts() -> Counter:
+    """Get the latest recommendation counts keyed by type (shared; do not mutate)."""
+    return recommendations_type_counts
@@ -3,50 +3,95 @@ SQLite-based cache for AI/LLM responses in OptiSchema.
 Caches OpenAI responses to reduce cost and latency.
 """
 
+import asyncio
 import os
 import sqlite3
 import threading
 import time
+from collections import OrderedDict
 from typing import Optional, Any
-from config import settings
+from config import get_settings
 
 CACHE_DB_PATH = os.path.join(os.path.dirname(__file__), 'llm_cache.sqlite3')
-CACHE_TTL = getattr(settings, 'cache_ttl', 3600)  # seconds
-CACHE_SIZE = getattr(settings, 'cache_size', 1000)
 
 # Ensure thread safety
 cache_lock = threading.Lock()
 
+# In-process LRU in front of SQLite: key -> (value, created_at)
+_mem: "OrderedDict[str, tuple]" = OrderedDict()
+_mem_lock = threading.Lock()
+
+# SQL statements (kept constant so sqlite3's statement cache can reuse them)
+_SELECT_SQL = 'SELECT value, created_at FROM cache WHERE key = ?'
+_REPLACE_SQL = 'REPLACE INTO cache (key, value, created_at) VALUES (?, ?, ?)'
+_COUNT_SQL = 'SELECT COUNT(*) FROM cache'
+_EVICT_SQL = 'DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY created_at ASC LIMIT ?)'
+_DELETE_SQL = 'DELETE FROM cache WHERE key = ?'
+_CLEAR_SQL = 'DELETE FROM cache'
+
+# Size enforcement only runs every EVICT_EVERY writes
+EVICT_EVERY = 64
+_write_counter = 0
+
+# Single persistent connection shared by all callers (serialized by cache_lock).
+# Autocommit mode + WAL avoids per-call connect/close and keeps writes cheap.
+_conn = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False, isolation_level=None)
+
 def _init_db():
     with cache_lock:
-        conn = sqlite3.connect(CACHE_DB_PATH)
-        c = conn.cursor()
-        c.execute('''
+        _conn.execute('PRAGMA journal_mode=WAL')
+        _conn.execute('PRAGMA synchronous=NORMAL')
+        _conn.execute('PRAGMA temp_store=MEMORY')
+        _conn.execute('PRAGMA mmap_size=134217728')
+        _conn.execute('''
             CREATE TABLE IF NOT EXISTS cache (
                 key TEXT PRIMARY KEY,
                 value TEXT,
                 created_at INTEGER
             )
         ''')
-        conn.commit()
-        conn.close()
+        _conn.execute('CREATE INDEX IF NOT EXISTS idx_created_at ON cache(created_at)')
 
 _init_db()
 
+def _cache_ttl() -> int:
+    """Seconds a cached response stays valid (CACHE_TTL)."""
+    return get_settings().cache_ttl
+
+def _cache_size() -> int:
+    """Maximum number of cached responses (CACHE_SIZE)."""
+    return get_settings().cache_size
+
 def make_cache_key(fingerprint: str, analysis_type: str) -> str:
     return f"{fingerprint}:{analysis_type}"
 
+def _mem_put(key: str, value: str, created_at: int):
+    with _mem_lock:
+        _mem[key] = (value, created_at)
+        _mem.move_to_end(key)
+        if len(_mem) > _cache_size():
+            _mem.popitem(last=False)
+
+def _mem_get(key: str, now: int) -> Optional[str]:
+    with _mem_lock:
+        entry = _mem.get(key)
+        if entry is not None:
+            _mem.move_to_end(key)
+    if entry is not None and now - entry[1] < _cache_ttl():
+        return entry[0]
+    return None
+
 def get_cache(key: str) -> Optional[str]:
     now = int(time.time())
+    value = _mem_get(key, now)
+    if value is not None:
+        return value
     with cache_lock:
-        conn = sqlite3.connect(CACHE_DB_PATH)
-        c = conn.cursor()
-        c.execute('SELECT value, created_at FROM cache WHERE key = ?', (key,))
-        row = c.fetchone()
-        conn.close()
+        row = _conn.execute(_SELECT_SQL, (key,)).fetchone()
     if row:
         value, created_at = row
-        if now - created_at < CACHE_TTL:
+        if now - created_at < _cache_ttl():
+            _mem_put(key, value, created_at)
             return value
         else:
             # Expired, delete
@@ -54,32 +99,39 @@ def get_cache(key: str) -> Optional[str]:
     return None
 
 def set_cache(key: str, value: str):
+    global _write_counter
     now = int(time.time())
+    _mem_put(key, value, now)
     with cache_lock:
-        conn = sqlite3.connect(CACHE_DB_PATH)
-        c = conn.cursor()
-        c.execute('REPLACE INTO cache (key, value, created_at) VALUES (?, ?, ?)', (key, value, now))
-        conn.commit()
+        _conn.execute(_REPLACE_SQL, (key, value, now))
+        _write_counter += 1
+        if _write_counter % EVICT_EVERY:
+            return
         # Enforce cache size
-        c.execute('SELECT COUNT(*) FROM cache')
-        count = c.fetchone()[0]
-        if count > CACHE_SIZE:
-            c.execute('DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created_at ASC LIMIT ?)', (count - CACHE_SIZE,))
-            conn.commit()
-        conn.close()
+        cache_size = _cache_size()
+        count = _conn.execute(_COUNT_SQL).fetchone()[0]
+        if count > cache_size:
+            _conn.execute(_EVICT_SQL, (count - cache_size,))
 
 def delete_cache(key: str):
+    with _mem_lock:
+        _mem.pop(key, None)
     with cache_lock:
-        conn = sqlite3.connect(CACHE_DB_PATH)
-        c = conn.cursor()
-        c.execute('DELETE FROM cache WHERE key = ?', (key,))
-        conn.commit()
-        conn.close()
+        _conn.execute(_DELETE_SQL, (key,))
 
 def clear_cache():
+    with _mem_lock:
+        _mem.clear()
     with cache_lock:
-        conn = sqlite3.connect(CACHE_DB_PATH)
-        c = conn.cursor()
-        c.execute('DELETE FROM cache')
-        conn.commit()
-        conn.close() 
\ No newline at end of file
+        _conn.execute(_CLEAR_SQL)
+
+async def aget_cache(key: str) -> Optional[str]:
+    """Async wrapper for get_cache that keeps SQLite I/O off the event loop."""
+    value = _mem_get(key, int(time.time()))
+    if value is not None:
+        return value
+    return await asyncio.to_thread(get_cache, key)
+
+async def aset_cache(key: str, value: str):
+    """Async wrapper for set_cache that keeps SQLite I/O off the event loop."""
+    await asyncio.to_thread(set_cache, key, value)
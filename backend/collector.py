@@ -5,56 +5,89 @@ Fetches and aggregates query metrics from pg_stat_statements.
 
 import asyncio
 import logging
-from typing import List, Dict, Any, Optional
+import numpy as np
+from typing import List, Dict, Any, Optional, Sequence, Tuple
 from datetime import datetime
 
-from db import get_pool
+from db import get_pool, db_transaction
 from connection_manager import connection_manager
 from models import QueryMetrics
-from config import settings
-from utils import calculate_performance_score
+from config import get_settings
+from sql import SQL_PG_STAT_COUNT, SQL_PG_STAT_ENABLED
+from utils import calculate_performance_score_vec, query_hash
 
 # Global collector task reference
 _collector_task: Optional[asyncio.Task] = None
 
-# In-memory cache for collected metrics
-metrics_cache: List[QueryMetrics] = []
+# In-memory cache for collected metrics. Always replaced wholesale with a new
+# tuple, so readers holding a reference see a consistent, immutable snapshot.
+metrics_cache: Tuple[QueryMetrics, ...] = ()
+# Columnar (struct-of-arrays) view of metrics_cache for vectorized aggregations
+metrics_columns: Dict[str, np.ndarray] = {}
+# JSON-ready dict per entry of metrics_cache, in the same order, for API responses
+metrics_cache_dicts: Tuple[Dict[str, Any], ...] = ()
+# Bumped whenever metrics_cache is replaced, so readers can memoize derived data
+metrics_cache_version: int = 0
 last_updated: datetime = None
 
 logger = logging.getLogger(__name__)
 
+# Numeric QueryMetrics fields exposed as columns, with their NumPy dtypes
+METRIC_COLUMNS = {
+    'total_time': np.int64,
+    'calls': np.int64,
+    'mean_time': np.float64,
+    'rows': np.int64,
+    'shared_blks_hit': np.int64,
+    'shared_blks_read': np.int64,
+    'performance_score': np.int64,
+    'time_percentage': np.float64,
+}
+
 # Configuration for large dataset handling
 MAX_QUERIES_DEFAULT = 50000  # Maximum queries to collect by default
 SAMPLING_THRESHOLD = 100000  # Start sampling when this many queries exist
 MIN_CALLS_FILTER = 1  # Only collect queries with at least this many calls (reduced for testing)
 MIN_TIME_FILTER = 0.0  # Only collect queries with at least this mean time (ms) (reduced for testing)
+PG_STAT_FETCH_SIZE = 1024  # Rows streamed per cursor fetch
 
+# Filtering, the LIMIT and each query's share of total time are all computed
+# server-side so only the selected rows cross the wire.
 PG_STAT_QUERY = """
+WITH s AS (
+    SELECT
+        query,
+        total_exec_time::BIGINT AS total_time,
+        calls::BIGINT,
+        mean_exec_time::FLOAT8 AS mean_time,
+        stddev_exec_time::FLOAT8 AS stddev_time,
+        min_exec_time::BIGINT AS min_time,
+        max_exec_time::BIGINT AS max_time,
+        rows::BIGINT,
+        shared_blks_hit::BIGINT,
+        shared_blks_read::BIGINT,
+        shared_blks_written::BIGINT,
+        shared_blks_dirtied::BIGINT,
+        temp_blks_read::BIGINT,
+        temp_blks_written::BIGINT,
+        blk_read_time::FLOAT8,
+        blk_write_time::FLOAT8
+    FROM pg_stat_statements
+    WHERE query NOT ILIKE 'EXPLAIN%' 
+      AND query NOT ILIKE 'DEALLOCATE%'
+      AND calls >= $1
+      AND mean_exec_time >= $2
+    ORDER BY total_exec_time DESC
+    LIMIT $3
+),
+t AS (
+    SELECT SUM(total_time) AS total FROM s
+)
 SELECT
-    md5(query) AS query_hash,
-    query,
-    total_exec_time::BIGINT AS total_time,
-    calls::BIGINT,
-    mean_exec_time::FLOAT8 AS mean_time,
-    stddev_exec_time::FLOAT8 AS stddev_time,
-    min_exec_time::BIGINT AS min_time,
-    max_exec_time::BIGINT AS max_time,
-    rows::BIGINT,
-    shared_blks_hit::BIGINT,
-    shared_blks_read::BIGINT,
-    shared_blks_written::BIGINT,
-    shared_blks_dirtied::BIGINT,
-    temp_blks_read::BIGINT,
-    temp_blks_written::BIGINT,
-    blk_read_time::FLOAT8,
-    blk_write_time::FLOAT8
-FROM pg_stat_statements
-WHERE query NOT ILIKE 'EXPLAIN%' 
-  AND query NOT ILIKE 'DEALLOCATE%'
-  AND calls >= $1
-  AND mean_exec_time >= $2
-ORDER BY total_exec_time DESC
-LIMIT $3;
+    s.*,
+    COALESCE(s.total_time * 100.0 / NULLIF(t.total, 0), 0)::FLOAT8 AS time_percentage
+FROM s, t
+ORDER BY s.total_time DESC;
 """
 
 async def fetch_pg_stat() -> List[QueryMetrics]:
@@ -73,27 +106,18 @@ async def fetch_pg_stat() -> List[QueryMetrics]:
     try:
         async with pool.acquire() as conn:
             # Check if pg_stat_statements is enabled
-            enabled = await conn.fetchval("""
-                SELECT EXISTS(
-                    SELECT 1 FROM pg_extension 
-                    WHERE extname = 'pg_stat_statements'
-                )
-            """)
+            enabled = await conn.fetchval(SQL_PG_STAT_ENABLED)
             
             if not enabled:
                 logger.warning("pg_stat_statements is not enabled")
                 return []
             
             # Get total queries count
-            total_queries = await conn.fetchval("""
-                SELECT COUNT(*) as total_queries 
-                FROM pg_stat_statements
-                WHERE query NOT ILIKE 'EXPLAIN%' AND query NOT ILIKE 'DEALLOCATE%'
-            """)
+            total_queries = await conn.fetchval(SQL_PG_STAT_COUNT)
             
-            logger.info(f"pg_stat_statements contains {total_queries} queries")
+            logger.info("pg_stat_statements contains %s queries", total_queries)
     except Exception as e:
-        logger.error(f"Error checking pg_stat_statements: {e}")
+        logger.error("Error checking pg_stat_statements: %s", e)
         return []
     
     # Adjust filtering based on dataset size
@@ -102,105 +126,146 @@ async def fetch_pg_stat() -> List[QueryMetrics]:
         min_calls = max(MIN_CALLS_FILTER, 10)
         min_time = max(MIN_TIME_FILTER, 5.0)
         limit = min(MAX_QUERIES_DEFAULT, 25000)
-        logger.warning(f"Large dataset detected ({total_queries} queries). Using aggressive filtering: min_calls={min_calls}, min_time={min_time}ms, limit={limit}")
+        logger.warning("Large dataset detected (%s queries). Using aggressive filtering: min_calls=%s, min_time=%sms, limit=%s", total_queries, min_calls, min_time, limit)
     elif total_queries > 50000:
         # Large dataset - use moderate filtering
         min_calls = max(MIN_CALLS_FILTER, 5)
         min_time = max(MIN_TIME_FILTER, 2.0)
         limit = MAX_QUERIES_DEFAULT
-        logger.info(f"Medium-large dataset detected ({total_queries} queries). Using moderate filtering: min_calls={min_calls}, min_time={min_time}ms")
+        logger.info("Medium-large dataset detected (%s queries). Using moderate filtering: min_calls=%s, min_time=%sms", total_queries, min_calls, min_time)
     else:
         # Normal dataset - use default filtering
         min_calls = MIN_CALLS_FILTER
         min_time = MIN_TIME_FILTER
         limit = MAX_QUERIES_DEFAULT
     
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(PG_STAT_QUERY, min_calls, min_time, limit)
-        
-        # Calculate total time for percentage calculations
-        total_time = sum(row['total_time'] for row in rows) if rows else 0
-        
-        metrics = []
-        for row in rows:
-            # Calculate percentage of total time
-            percentage_of_total_time = (row['total_time'] / total_time * 100) if total_time > 0 else 0
-            
-            # Create a mock hot_query object for performance score calculation
-            hot_query = type('HotQuery', (), {
-                'mean_time': row['mean_time'],
-                'calls': row['calls'],
-                'percentage_of_total_time': percentage_of_total_time,
-                'shared_blks_hit': row['shared_blks_hit'],
-                'shared_blks_read': row['shared_blks_read'],
-                'rows': row['rows']
-            })()
-            
-            # Calculate performance score
-            performance_score = round(calculate_performance_score(hot_query, None))
-            
-            metric = QueryMetrics(
-                query_hash=row['query_hash'],
-                query_text=row['query'],
-                total_time=row['total_time'],
-                calls=row['calls'],
-                mean_time=row['mean_time'],
-                stddev_time=row['stddev_time'],
-                min_time=row['min_time'],
-                max_time=row['max_time'],
-                rows=row['rows'],
-                shared_blks_hit=row['shared_blks_hit'],
-                shared_blks_read=row['shared_blks_read'],
-                shared_blks_written=row['shared_blks_written'],
-                shared_blks_dirtied=row['shared_blks_dirtied'],
-                temp_blks_read=row['temp_blks_read'],
-                temp_blks_written=row['temp_blks_written'],
-                blk_read_time=row['blk_read_time'],
-                blk_write_time=row['blk_write_time'],
-                performance_score=performance_score,
-                time_percentage=percentage_of_total_time
-            )
-            metrics.append(metric)
-        
-        return metrics
+    metrics: List[QueryMetrics] = []
+    # Cursors need a transaction. Rows are streamed in chunks so only one
+    # chunk of Records is alive at a time instead of the whole result set.
+    # conn.cursor goes through asyncpg's per-connection statement cache, so
+    # PG_STAT_QUERY is only parsed/prepared once per pooled connection
+    # (an explicit conn.prepare() would bypass that cache)
+    async with db_transaction(readonly=True) as conn:
+        cursor = await conn.cursor(PG_STAT_QUERY, min_calls, min_time, limit)
+        while True:
+            rows = await cursor.fetch(PG_STAT_FETCH_SIZE)
+            if not rows:
+                break
+            # Scoring and model construction are CPU-bound; keep them off the event loop
+            metrics.extend(await asyncio.to_thread(build_query_metrics, rows))
+    
+    return metrics
+
+def build_query_metrics(rows: Sequence[Any]) -> List[QueryMetrics]:
+    """Build scored QueryMetrics from PG_STAT_QUERY rows."""
+    count = len(rows)
+    
+    def column(name: str) -> np.ndarray:
+        return np.fromiter((row[name] for row in rows), dtype=np.float64, count=count)
+    
+    # Score the whole batch in one vectorized pass
+    scores = calculate_performance_score_vec(
+        column('mean_time'), column('calls'), column('time_percentage'),
+        column('shared_blks_hit'), column('shared_blks_read'), column('rows')
+    ).tolist()
+    
+    metrics = []
+    for row, performance_score in zip(rows, scores):
+        # Rows come straight from typed SQL casts, so skip pydantic validation
+        metric = QueryMetrics.model_construct(
+            query_hash=query_hash(row['query']),
+            query_text=row['query'],
+            total_time=row['total_time'],
+            calls=row['calls'],
+            mean_time=row['mean_time'],
+            stddev_time=row['stddev_time'],
+            min_time=row['min_time'],
+            max_time=row['max_time'],
+            rows=row['rows'],
+            shared_blks_hit=row['shared_blks_hit'],
+            shared_blks_read=row['shared_blks_read'],
+            shared_blks_written=row['shared_blks_written'],
+            shared_blks_dirtied=row['shared_blks_dirtied'],
+            temp_blks_read=row['temp_blks_read'],
+            temp_blks_written=row['temp_blks_written'],
+            blk_read_time=row['blk_read_time'],
+            blk_write_time=row['blk_write_time'],
+            performance_score=performance_score,
+            time_percentage=row['time_percentage']
+        )
+        metrics.append(metric)
+    
+    return metrics
+
+def build_metrics_columns(metrics: Sequence[QueryMetrics]) -> Dict[str, np.ndarray]:
+    """Build a columnar view of query metrics (missing values become 0)."""
+    count = len(metrics)
+    columns = {
+        field: np.fromiter((getattr(m, field) or 0 for m in metrics), dtype=dtype, count=count)
+        for field, dtype in METRIC_COLUMNS.items()
+    }
+    columns['query_hash'] = np.array([m.query_hash for m in metrics], dtype=object)
+    # Case-folded once per refresh so text search doesn't lower() per request
+    columns['query_text_lower'] = np.array([m.query_text.lower() for m in metrics], dtype=object)
+    return columns
+
+def build_metrics_dicts(metrics: Sequence[QueryMetrics]) -> Tuple[Dict[str, Any], ...]:
+    """Serialize query metrics to JSON-ready dictionaries."""
+    return tuple(m.model_dump(mode='json') for m in metrics)
 
 async def poll_pg_stat():
     """Scheduled polling of pg_stat_statements every polling_interval seconds."""
-    global metrics_cache, last_updated
+    global metrics_cache, metrics_columns, metrics_cache_dicts, metrics_cache_version, last_updated
     while True:
         try:
             logger.info("Polling pg_stat_statements for query metrics...")
-            metrics = await fetch_pg_stat()
+            metrics = tuple(await fetch_pg_stat())
+            columns = await asyncio.to_thread(build_metrics_columns, metrics)
+            dicts = await asyncio.to_thread(build_metrics_dicts, metrics)
+            # Publish both views together so readers never see them out of sync
             metrics_cache = metrics
+            metrics_columns = columns
+            metrics_cache_dicts = dicts
+            metrics_cache_version += 1
             last_updated = datetime.utcnow()
-            logger.info(f"Fetched {len(metrics)} query metrics at {last_updated}")
+            logger.info("Fetched %d query metrics at %s", len(metrics), last_updated)
         except Exception as e:
-            logger.error(f"Error polling pg_stat_statements: {e}")
-        await asyncio.sleep(settings.polling_interval)
+            logger.error("Error polling pg_stat_statements: %s", e)
+        await asyncio.sleep(get_settings().polling_interval)
 
 
-def get_metrics_cache() -> List[QueryMetrics]:
-    """Get the latest cached query metrics."""
+def get_metrics_cache() -> Tuple[QueryMetrics, ...]:
+    """Get the latest cached query metrics snapshot."""
     return metrics_cache
 
+def get_metrics_columns() -> Dict[str, np.ndarray]:
+    """Get the latest cached query metrics as NumPy columns."""
+    return metrics_columns
+
+def get_metrics_cache_dicts() -> Tuple[Dict[str, Any], ...]:
+    """Get the latest cached query metrics as JSON-ready dictionaries (do not mutate)."""
+    return metrics_cache_dicts
+
+def get_metrics_cache_version() -> int:
+    """Get the version of the current metrics snapshot (changes on every refresh)."""
+    return metrics_cache_version
+
 def get_last_updated() -> datetime:
     """Get the last updated timestamp for metrics cache."""
     return last_updated
 
 async def restart_collector():
     """Restart the collector task when database connection changes."""
-    global _collector_task, metrics_cache, last_updated
+    global _collector_task, metrics_cache, metrics_columns, metrics_cache_dicts, metrics_cache_version, last_updated
     
     # Cancel existing task if running
-    if _collector_task and not _collector_task.done():
-        _collector_task.cancel()
-        try:
-            await _collector_task
-        except asyncio.CancelledError:
-            pass
+    await stop_collector()
     
     # Clear the cache
-    metrics_cache = []
+    metrics_cache = ()
+    metrics_columns = {}
+    metrics_cache_dicts = ()
+    metrics_cache_version += 1
     last_updated = None
     
     # Start new collector task
@@ -208,8 +273,20 @@ async def restart_collector():
     _collector_task = loop.create_task(poll_pg_stat())
     logger.info("✅ Restarted pg_stat_statements polling task")
 
+async def stop_collector():
+    """Cancel the collector task, if running, and wait for it to finish."""
+    global _collector_task
+    if _collector_task and not _collector_task.done():
+        _collector_task.cancel()
+        try:
+            await _collector_task
+        except asyncio.CancelledError:
+            pass
+    _collector_task = None
+
 def initialize_collector():
     """Initialize the collector and register connection change callback."""
+    global _collector_task
     # Register callback for connection changes
     connection_manager.add_connection_change_callback(restart_collector)
     logger.info("✅ Registered collector restart callback")
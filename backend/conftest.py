@@ -0,0 +1,36 @@
+"""
+Pytest configuration for the OptiSchema backend test scripts.
+Runs every async test on one session-wide event loop, so module-level
+clients such as the LLM HTTP session are opened once and reused.
+"""
+
+import asyncio
+import sys
+
+import pytest
+import pytest_asyncio
+
+
+def pytest_collection_modifyitems(items):
+    """Run the scripts' plain async test functions under pytest-asyncio."""
+    for item in items:
+        if asyncio.iscoroutinefunction(getattr(item, "function", None)):
+            item.add_marker(pytest.mark.asyncio)
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    """One event loop for the whole test run."""
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest_asyncio.fixture(scope="session", autouse=True)
+async def llm_session():
+    """Close the shared LLM HTTP session once all tests have run."""
+    yield
+    # Only tests that used the LLM client load it (and its settings)
+    llm = sys.modules.get("analysis.llm")
+    if llm is not None:
+        await llm.close_session()
@@ -5,21 +5,71 @@ Handles dynamic database connection switching and management.
 
 import asyncio
 import logging
-from typing import Optional, Dict, Any
+import os
+from collections import deque
+from types import MappingProxyType
+from typing import Optional, Dict, Any, Mapping
 import asyncpg
 from asyncpg import Pool, Connection
-from datetime import datetime
+import time
+from datetime import datetime, timezone
+
+from config import get_settings
+from sql import SQL_CREATE_PG_STAT_EXTENSION, SQL_EXTENSION_STATUS, SQL_SELECT_1, SQL_TEST_CONNECTION
 
 logger = logging.getLogger(__name__)
 
+
+def _connect_args(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Build asyncpg connection arguments from a database configuration."""
+    # Prepare SSL configuration
+    ssl_config = 'require' if config.get('ssl', False) else None
+    
+    # Configs parsed from a URL carry the original DSN; let asyncpg parse it
+    if config.get('dsn'):
+        return {'dsn': config['dsn'], 'ssl': ssl_config}
+    
+    return {
+        'host': config['host'],
+        'port': config['port'],
+        'database': config['database'],
+        'user': config['user'],
+        'password': config['password'],
+        'ssl': ssl_config
+    }
+
+
+def _pool_sizes(settings) -> tuple:
+    """
+    Per-worker (min_size, max_size) for the connection pool.
+    
+    Each uvicorn worker process opens its own pool, so the configured
+    max size is divided across WEB_CONCURRENCY workers.
+    """
+    try:
+        workers = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
+    except ValueError:
+        workers = 1
+    max_size = max(1, settings.db_pool_max_size // workers)
+    return min(settings.db_pool_min_size, max_size), max_size
+
+
+def _config_key(config: Dict[str, Any]) -> tuple:
+    """Hashable identity of a database configuration."""
+    return tuple(sorted((key, str(value)) for key, value in config.items()))
+
+
 class ConnectionManager:
     """Manages database connections and allows dynamic switching."""
     
     def __init__(self):
         self._current_pool: Optional[Pool] = None
-        self._current_config: Optional[Dict[str, Any]] = None
-        self._connection_history: list = []
+        self._current_config: Optional[Mapping[str, Any]] = None
+        # Only the last 10 connections are kept in history
+        self._connection_history: deque = deque(maxlen=10)
         self._lock = asyncio.Lock()
+        # In-flight connect attempts keyed by configuration
+        self._connecting: Dict[tuple, asyncio.Task] = {}
         self._connection_change_callbacks: list = []
     
     def add_connection_change_callback(self, callback):
@@ -32,95 +82,133 @@ class ConnectionManager:
             try:
                 await callback()
             except Exception as e:
-                logger.error(f"Error in connection change callback: {e}")
+                logger.error("Error in connection change callback: %s", e)
     
     async def connect(self, config: Dict[str, Any]) -> bool:
         """
         Connect to a new database.
         
+        Concurrent calls for the same configuration share a single attempt.
+        
         Args:
             config: Database configuration dictionary
             
         Returns:
             True if connection successful, False otherwise
         """
+        key = _config_key(config)
+        task = self._connecting.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._connect(config))
+            self._connecting[key] = task
+            task.add_done_callback(lambda _: self._connecting.pop(key, None))
+        # Shield so one cancelled caller doesn't abort the shared attempt
+        return await asyncio.shield(task)
+    
+    async def _connect(self, config: Dict[str, Any]) -> bool:
+        """Open a pool for config and make it the current connection."""
+        try:
+            # Pool creation and validation are network-bound; keep them outside the lock
+            pool = await self._open_pool(config)
+        except Exception as e:
+            logger.error("Failed to connect to database: %s", e)
+            return False
+        
+        if pool is None:
+            return False
+        
+        # One read-only copy shared by the current config and the history entry,
+        # so later changes to the caller's dict can't leak into stored state
+        snapshot = MappingProxyType(dict(config))
+        
+        # Only the swap of shared state is serialized
         async with self._lock:
+            old_pool, self._current_pool = self._current_pool, pool
+            self._current_config = snapshot
+            
+            # Add to history
+            self._connection_history.append({
+                'config': snapshot,
+                # Integer timestamp; converted to a datetime only when history is read
+                'connected_at_ns': time.time_ns(),
+                'status': 'connected'
+            })
+        
+        # Close the previous connection, if any, once nobody can pick it up anymore
+        if old_pool:
             try:
-                # Close existing connection if any
-                if self._current_pool:
-                    await self._current_pool.close()
-                
-                # Prepare SSL configuration
-                ssl_config = None
-                if config.get('ssl', False):
-                    ssl_config = 'require'
-                
-                # Create new connection pool
-                pool = await asyncpg.create_pool(
-                    host=config['host'],
-                    port=config['port'],
-                    database=config['database'],
-                    user=config['user'],
-                    password=config['password'],
-                    ssl=ssl_config,
-                    min_size=5,
-                    max_size=20,
-                    command_timeout=60,
-                    server_settings={
-                        'application_name': 'optischema_backend',
-                        'search_path': 'optischema,public'
-                    }
-                )
-                
-                # Test the connection
-                async with pool.acquire() as conn:
-                    # Check if pg_stat_statements extension is available
-                    extension_exists = await conn.fetchval(
-                        "SELECT EXISTS(SELECT 1 FROM pg_available_extensions WHERE name = 'pg_stat_statements')"
-                    )
-                    
-                    if not extension_exists:
-                        await pool.close()
-                        logger.error("pg_stat_statements extension not available")
-                        return False
-                    
-                    # Check if extension is enabled
-                    extension_enabled = await conn.fetchval(
-                        "SELECT EXISTS(SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements')"
-                    )
-                    
-                    if not extension_enabled:
-                        # Try to enable the extension
-                        try:
-                            await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_stat_statements")
-                            logger.info("pg_stat_statements extension enabled")
-                        except Exception as e:
-                            logger.warning(f"Could not enable pg_stat_statements: {e}")
-                
-                # Update current connection
-                self._current_pool = pool
-                self._current_config = config.copy()
-                
-                # Add to history
-                self._connection_history.append({
-                    'config': config.copy(),
-                    'connected_at': datetime.utcnow(),
-                    'status': 'connected'
-                })
-                
-                # Keep only last 10 connections in history
-                if len(self._connection_history) > 10:
-                    self._connection_history = self._connection_history[-10:]
-                
-                # Notify about connection change
-                await self._notify_connection_change()
-                
-                logger.info(f"Successfully connected to {config['host']}:{config['port']}/{config['database']}")
-                return True
-                
+                await old_pool.close()
             except Exception as e:
-                logger.error(f"Failed to connect to database: {e}")
-                return False
+                logger.warning("Error closing previous connection pool: %s", e)
+        
+        # Notify about connection change
+        await self._notify_connection_change()
+        
+        logger.info("Successfully connected to %s:%s/%s", config['host'], config['port'], config['database'])
+        return True
+    
+    async def _open_pool(self, config: Dict[str, Any]) -> Optional[Pool]:
+        """
+        Create a connection pool for config and validate it.
+        
+        Returns:
+            The new pool, or None if pg_stat_statements is not available
+        """
+        # Create new connection pool
+        settings = get_settings()
+        min_size, max_size = _pool_sizes(settings)
+        # Sent once in the startup packet, so no per-session SET round-trips.
+        # pgbouncer rejects startup parameters it doesn't track and can't keep
+        # session settings in transaction pooling, so behind it only
+        # application_name is sent; set the rest on the database role instead.
+        server_settings = {'application_name': 'optischema_backend'}
+        if not settings.db_pgbouncer:
+            server_settings.update({
+                'search_path': 'optischema,public',
+                # Telemetry queries are short; JIT compilation only adds latency
+                'jit': 'off',
+                # Abort server-side work the client has already timed out on
+                'statement_timeout': str(int(settings.db_command_timeout * 1000))
+            })
+        pool = await asyncpg.create_pool(
+            **_connect_args(config),
+            min_size=min_size,
+            max_size=max_size,
+            max_queries=settings.db_pool_max_queries,
+            max_inactive_connection_lifetime=settings.db_pool_max_inactive_lifetime,
+            command_timeout=settings.db_command_timeout,
+            # Keep the per-connection prepared statement cache enabled so
+            # repeated queries (e.g. the pg_stat_statements poll) skip parse/plan.
+            # It is sized so one-off EXPLAIN statements don't evict the hot ones.
+            # pgbouncer's transaction pooling can't keep prepared statements.
+            statement_cache_size=0 if settings.db_pgbouncer else settings.db_statement_cache_size,
+            server_settings=server_settings
+        )
+        
+        # Test the connection
+        try:
+            async with pool.acquire() as conn:
+                # Check if pg_stat_statements extension is available and enabled
+                extension_status = await conn.fetchrow(SQL_EXTENSION_STATUS)
+                
+                if extension_status['available'] and not extension_status['enabled']:
+                    # Try to enable the extension
+                    try:
+                        await conn.execute(SQL_CREATE_PG_STAT_EXTENSION)
+                        logger.info("pg_stat_statements extension enabled")
+                    except Exception as e:
+                        logger.warning("Could not enable pg_stat_statements: %s", e)
+        except Exception:
+            await pool.close()
+            raise
+        
+        if not extension_status['available']:
+            # Closed after the probe connection is released; Pool.close waits for it
+            await pool.close()
+            logger.error("pg_stat_statements extension not available")
+            return None
+        
+        return pool
     
     async def get_pool(self) -> Optional[Pool]:
         """Get the current connection pool."""
@@ -133,13 +221,21 @@ class ConnectionManager:
             return await pool.acquire()
         return None
     
-    def get_current_config(self) -> Optional[Dict[str, Any]]:
-        """Get the current database configuration."""
+    def get_current_config(self) -> Optional[Mapping[str, Any]]:
+        """Get the current database configuration (read-only)."""
         return self._current_config
     
     def get_connection_history(self) -> list:
         """Get the connection history."""
-        return self._connection_history.copy()
+        return [
+            {
+                # Plain dict so the entry serializes in API responses
+                'config': dict(entry['config']),
+                'connected_at': datetime.fromtimestamp(entry['connected_at_ns'] / 1e9, tz=timezone.utc),
+                'status': entry['status']
+            }
+            for entry in self._connection_history
+        ]
     
     def clear_connection_history(self):
         """Clear the connection history."""
@@ -172,35 +268,11 @@ class ConnectionManager:
             Test result dictionary
         """
         try:
-            # Prepare SSL configuration
-            ssl_config = None
-            if config.get('ssl', False):
-                ssl_config = 'require'
-            
             # Create a temporary connection
-            conn = await asyncpg.connect(
-                host=config['host'],
-                port=config['port'],
-                database=config['database'],
-                user=config['user'],
-                password=config['password'],
-                ssl=ssl_config
-            )
-            
-            # Check if pg_stat_statements extension is available
-            extension_exists = await conn.fetchval(
-                "SELECT EXISTS(SELECT 1 FROM pg_available_extensions WHERE name = 'pg_stat_statements')"
-            )
-            
-            # Check if extension is enabled
-            extension_enabled = await conn.fetchval(
-                "SELECT EXISTS(SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements')"
-            )
+            conn = await asyncpg.connect(**_connect_args(config))
             
-            # Get database info
-            db_info = await conn.fetchrow(
-                "SELECT version(), current_database(), current_user"
-            )
+            # Get database info and pg_stat_statements status in one round-trip
+            db_info = await conn.fetchrow(SQL_TEST_CONNECTION)
             
             await conn.close()
             
@@ -211,8 +283,8 @@ class ConnectionManager:
                     'version': db_info[0],
                     'database': db_info[1],
                     'user': db_info[2],
-                    'pg_stat_statements_available': extension_exists,
-                    'pg_stat_statements_enabled': extension_enabled
+                    'pg_stat_statements_available': db_info['available'],
+                    'pg_stat_statements_enabled': db_info['enabled']
                 }
             }
             
@@ -233,11 +305,10 @@ class ConnectionManager:
             return False
         
         try:
-            async with self._current_pool.acquire() as conn:
-                await conn.fetchval("SELECT 1")
+            await self._current_pool.fetchval(SQL_SELECT_1)
             return True
         except Exception as e:
-            logger.error(f"Connection health check failed: {e}")
+            logger.error("Connection health check failed: %s", e)
             # Connection is broken, clear it
             self._current_pool = None
             self._current_config = None
@@ -5,16 +5,22 @@ Handles async PostgreSQL connection pooling and health checks.
 
 import asyncio
 import logging
-from typing import Optional, Dict, Any
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Callable, Optional, Any, Mapping
 import asyncpg
 from asyncpg import Pool, Connection
 
-from config import settings, get_database_config
+from config import get_database_config
 from connection_manager import connection_manager
+from sql import SQL_SELECT_1
 
 # Configure logging
 logger = logging.getLogger(__name__)
 
+# How long a database health probe result is reused (seconds)
+HEALTH_CHECK_TTL = 0.5
+
 
 async def initialize_database():
     """Initialize the database connection using the connection manager."""
@@ -30,7 +36,7 @@ async def initialize_database():
         return success
         
     except Exception as e:
-        logger.error(f"Failed to initialize database connection: {e}")
+        logger.error("Failed to initialize database connection: %s", e)
         return False
 
 
@@ -44,30 +50,96 @@ async def get_connection() -> Optional[Connection]:
     return await connection_manager.get_connection()
 
 
+@asynccontextmanager
+async def db_transaction(**transaction_options) -> AsyncIterator[Connection]:
+    """
+    Acquire a pooled connection and run the block inside a transaction.
+    
+    The transaction commits on normal exit, rolls back on error, and the
+    connection is always released back to the pool.
+    
+    Args:
+        **transaction_options: Passed to Connection.transaction (e.g. readonly=True)
+    """
+    pool = await get_pool()
+    if pool is None:
+        raise RuntimeError("Database connection not available")
+    async with pool.acquire() as conn:
+        async with conn.transaction(**transaction_options):
+            yield conn
+
+
 async def close_pool():
     """Close the current connection pool."""
     await connection_manager.disconnect()
 
 
-async def health_check() -> bool:
-    """Check if the database connection is healthy."""
+async def _probe_health() -> bool:
+    """Run a SELECT 1 health probe against the current pool."""
     try:
         pool = await get_pool()
         if pool is None:
             return False
-            
-        async with pool.acquire() as conn:
-            # Execute a simple query to test the connection
-            await conn.fetchval("SELECT 1")
+        
+        # Pool.fetchval acquires and releases a connection internally
+        await pool.fetchval(SQL_SELECT_1)
         return True
         
     except Exception as e:
-        logger.error(f"Database health check failed: {e}")
+        logger.error("Database health check failed: %s", e)
         return False
 
 
-def get_current_config() -> Optional[Dict[str, Any]]:
-    """Get the current database configuration."""
+class _CachedHealthCheck:
+    """
+    Health probe with a short TTL cache and single-flight coalescing.
+    
+    Concurrent callers share one in-flight probe, and results are reused
+    for `ttl` seconds, so load balancer polling costs at most one
+    database round-trip per interval. If `scope` is given, it returns the
+    object the probe checks (e.g. the current pool); a result or in-flight
+    probe is only shared while the scope is the same object.
+    """
+    
+    def __init__(self, probe: Callable[[], Awaitable[bool]], ttl: float,
+                 scope: Optional[Callable[[], Awaitable[Any]]] = None):
+        self._probe = probe
+        self._ttl = ttl
+        self._scope = scope
+        self._expires_at = 0.0
+        self._result = False
+        self._result_scope: Any = None
+        self._inflight: Optional[asyncio.Future] = None
+        self._inflight_scope: Any = None
+    
+    async def __call__(self) -> bool:
+        scope = await self._scope() if self._scope is not None else None
+        if time.monotonic() < self._expires_at and scope is self._result_scope:
+            return self._result
+        if self._inflight is None or scope is not self._inflight_scope:
+            self._inflight = asyncio.ensure_future(self._run(scope))
+            self._inflight_scope = scope
+        # Shield so one cancelled caller doesn't cancel the shared probe
+        return await asyncio.shield(self._inflight)
+    
+    async def _run(self, scope: Any) -> bool:
+        try:
+            result = await self._probe()
+            self._result = result
+            self._result_scope = scope
+            self._expires_at = time.monotonic() + self._ttl
+            return result
+        finally:
+            if self._inflight is asyncio.current_task():
+                self._inflight = None
+
+
+# Check if the database connection is healthy (cached for HEALTH_CHECK_TTL seconds)
+health_check = _CachedHealthCheck(_probe_health, HEALTH_CHECK_TTL)
+
+
+def get_current_config() -> Optional[Mapping[str, Any]]:
+    """Get the current database configuration (read-only)."""
     return connection_manager.get_current_config()
 
 
@@ -7,50 +7,53 @@ import asyncio
 import logging
 import time
 from contextlib import asynccontextmanager
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Dict, Any
 
 from fastapi import FastAPI, HTTPException, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from fastapi import APIRouter
 
-from config import settings
+from config import get_settings
 from db import initialize_database, close_pool, health_check as db_health_check
 from models import HealthCheck, WebSocketMessage, APIResponse
-from collector import poll_pg_stat, get_metrics_cache, initialize_collector
+from collector import poll_pg_stat, get_metrics_cache, initialize_collector, stop_collector
 from analysis.pipeline import start_analysis_scheduler
+from analysis.llm import close_session as close_llm_session
+from sandbox import close_sandbox_pool
 
-# Configure logging
-logging.basicConfig(
-    level=getattr(logging, settings.log_level),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger(__name__)
 
+
+def configure_logging():
+    """Configure root logging from the settings (LOG_LEVEL)."""
+    logging.basicConfig(
+        level=getattr(logging, get_settings().log_level),
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+
 # Global variables
-start_time = time.time()
+start_time = time.monotonic()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan manager."""
-    # Startup
+    # Startup (settings are loaded and validated here, not at import)
+    configure_logging()
     logger.info("🚀 Starting OptiSchema backend...")
     
     # Database connection will be established when user provides credentials
     logger.info("✅ Database connection will be established when user provides credentials")
     
     # Initialize the collector with connection change callback
+    # (the collector module tracks its own task handle)
     initialize_collector()
-    
-    # Collector task will be started when user connects to database
-    collector_task = None
     logger.info("✅ Collector ready - will start when database connection is established")
     
     # Start the analysis scheduler
-    loop = asyncio.get_event_loop()
-    analysis_task = loop.create_task(start_analysis_scheduler())
+    analysis_task = asyncio.create_task(start_analysis_scheduler())
     logger.info("✅ Started analysis scheduler")
     
     logger.info("✅ OptiSchema backend started successfully")
@@ -60,12 +63,12 @@ async def lifespan(app: FastAPI):
     # Shutdown
     logger.info("🛑 Shutting down OptiSchema backend...")
     
+    # Close the shared LLM HTTP session
+    await close_llm_session()
+    logger.info("✅ LLM HTTP session closed")
+    
     # Cancel the collector task
-    collector_task.cancel()
-    try:
-        await collector_task
-    except asyncio.CancelledError:
-        pass
+    await stop_collector()
     logger.info("✅ Collector task cancelled")
     
     # Cancel the analysis task
@@ -80,6 +83,10 @@ async def lifespan(app: FastAPI):
     await close_pool()
     logger.info("✅ Database connection pool closed")
     
+    # Close the sandbox connection pool
+    await close_sandbox_pool()
+    logger.info("✅ Sandbox connection pool closed")
+    
     logger.info("✅ OptiSchema backend shutdown complete")
 
 
@@ -90,6 +97,8 @@ app = FastAPI(
     version="1.0.0",
     docs_url="/docs",
     redoc_url="/redoc",
+    # orjson is much faster than the stdlib encoder for large metric payloads
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -135,29 +144,29 @@ async def health_check():
         db_healthy = await db_health_check()
         
         # Check OpenAI API (basic check - we'll implement this later)
-        openai_healthy = bool(settings.openai_api_key)
+        openai_healthy = bool(get_settings().openai_api_key)
         
         # Determine overall status
         status = "healthy" if db_healthy and openai_healthy else "unhealthy"
         
         return HealthCheck(
             status=status,
-            timestamp=datetime.utcnow(),
+            timestamp=datetime.now(timezone.utc),
             database=db_healthy,
             openai=openai_healthy,
             version="1.0.0",
-            uptime=time.time() - start_time
+            uptime=time.monotonic() - start_time
         )
         
     except Exception as e:
-        logger.error(f"Health check failed: {e}")
+        logger.error("Health check failed: %s", e)
         return HealthCheck(
             status="unhealthy",
-            timestamp=datetime.utcnow(),
+            timestamp=datetime.now(timezone.utc),
             database=False,
             openai=False,
             version="1.0.0",
-            uptime=time.time() - start_time
+            uptime=time.monotonic() - start_time
         )
 
 
@@ -181,13 +190,13 @@ async def websocket_endpoint(websocket: WebSocket):
 @app.exception_handler(Exception)
 async def global_exception_handler(request, exc):
     """Global exception handler."""
-    logger.error(f"Unhandled exception: {exc}")
-    return JSONResponse(
+    logger.error("Unhandled exception: %s", exc)
+    return ORJSONResponse(
         status_code=500,
         content={
             "success": False,
             "message": "Internal server error",
-            "error": str(exc) if settings.debug else "An unexpected error occurred"
+            "error": str(exc) if get_settings().debug else "An unexpected error occurred"
         }
     )
 
@@ -195,7 +204,7 @@ async def global_exception_handler(request, exc):
 @app.exception_handler(HTTPException)
 async def http_exception_handler(request, exc):
     """HTTP exception handler."""
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=exc.status_code,
         content={
             "success": False,
@@ -215,10 +224,15 @@ async def http_exception_handler(request, exc):
 if __name__ == "__main__":
     import uvicorn
     
+    settings = get_settings()
+    configure_logging()
     uvicorn.run(
         "main:app",
         host=settings.backend_host,
         port=settings.backend_port,
         reload=settings.backend_reload,
-        log_level=settings.log_level.lower()
+        log_level=settings.log_level.lower(),
+        ws_per_message_deflate=settings.ws_per_message_deflate,
+        # libuv-based event loop; asyncpg has fast paths for it
+        loop="uvloop"
     ) 
\ No newline at end of file
@@ -38,12 +38,15 @@ class QueryMetrics(BaseModel):
 class ExecutionPlan(BaseModel):
     """Model for PostgreSQL execution plan analysis."""
     
-    plan_json: Dict[str, Any] = Field(..., description="Raw execution plan JSON")
+    plan_json: Any = Field(..., description="Raw execution plan JSON (EXPLAIN returns a list)")
     total_cost: Optional[float] = Field(None, description="Total cost of the plan")
     total_time: Optional[float] = Field(None, description="Estimated total time")
     planning_time: Optional[float] = Field(None, description="Planning time")
     execution_time: Optional[float] = Field(None, description="Execution time")
     nodes: List[Dict[str, Any]] = Field(default_factory=list, description="Plan nodes")
+    bottlenecks: List[Dict[str, Any]] = Field(default_factory=list, description="Detected plan bottlenecks")
+    key_insights: List[str] = Field(default_factory=list, description="Summary insights from the plan nodes")
+    recommendations: List[str] = Field(default_factory=list, description="Summary recommendations from the plan nodes")
 
 
 class AnalysisResult(BaseModel):
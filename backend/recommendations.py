@@ -3,6 +3,7 @@ Recommendation generation for OptiSchema backend.
 Combines heuristics and AI to generate actionable optimization suggestions.
 """
 
+import asyncio
 import logging
 import uuid
 from typing import List, Dict, Any, Optional
@@ -10,9 +11,34 @@ from datetime import datetime
 from models import QueryMetrics, Recommendation, AnalysisResult
 from analysis.core import detect_basic_issues
 from analysis.llm import generate_recommendation, rewrite_query
+from config import get_settings
 
 logger = logging.getLogger(__name__)
 
+# Caps how many analyses talk to the LLM at once
+_llm_semaphore: Optional[asyncio.Semaphore] = None
+
+# Estimated improvement (%) for high-impact bottleneck types
+BOTTLENECK_IMPROVEMENT = {
+    "sequential_scan": 50,
+    "missing_index": 40,
+    "large_sort": 20,
+}
+# Bottleneck types that boost recommendation confidence
+HIGH_IMPACT_BOTTLENECKS = frozenset(BOTTLENECK_IMPROVEMENT)
+# Bottleneck types that get an "Add Index" recommendation
+INDEX_BOTTLENECKS = frozenset({"sequential_scan", "missing_index"})
+# Bottleneck types that also get an AI query rewrite
+REWRITE_BOTTLENECKS = frozenset({"sequential_scan", "large_sort", "inefficient_select"})
+
+
+def _get_llm_semaphore() -> asyncio.Semaphore:
+    """Get the shared LLM concurrency limiter, creating it on first use."""
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(max(1, get_settings().openai_max_concurrency))
+    return _llm_semaphore
+
 
 def score_recommendation(analysis: AnalysisResult) -> int:
     """
@@ -23,7 +49,7 @@ def score_recommendation(analysis: AnalysisResult) -> int:
     if analysis.performance_score is not None:
         score += int(analysis.performance_score / 2)
     # Heuristic: boost for detected bottlenecks
-    if analysis.bottleneck_type in ("sequential_scan", "missing_index", "large_sort"):
+    if analysis.bottleneck_type in HIGH_IMPACT_BOTTLENECKS:
         score += 20
     # Cap between 0 and 100
     return max(0, min(100, score))
@@ -34,12 +60,9 @@ def estimate_improvement(analysis: AnalysisResult) -> int:
     Estimate the percent improvement if the recommendation is applied.
     """
     # Simple heuristic: higher for high-impact bottlenecks
-    if analysis.bottleneck_type == "sequential_scan":
-        return 50
-    if analysis.bottleneck_type == "missing_index":
-        return 40
-    if analysis.bottleneck_type == "large_sort":
-        return 20
+    improvement = BOTTLENECK_IMPROVEMENT.get(analysis.bottleneck_type)
+    if improvement is not None:
+        return improvement
     if analysis.performance_score is not None and analysis.performance_score < 50:
         return 10
     return 5
@@ -50,87 +73,92 @@ async def generate_recommendations_for_analysis(analysis: AnalysisResult) -> Lis
     Generate recommendations for a single analysis result.
     Combines heuristics and AI suggestions.
     """
-    recs: List[Recommendation] = []
-    # Heuristic recommendations
-    if analysis.bottleneck_type in ("sequential_scan", "missing_index"):
-        recs.append(Recommendation(
-            id=str(uuid.uuid4()),
+    # All recommendations from one analysis share a creation time and scores
+    now = datetime.utcnow()
+    improvement = estimate_improvement(analysis)
+    confidence = score_recommendation(analysis)
+    
+    def _mk(recommendation_type: str, title: str, description: str,
+            sql_fix: Optional[str], risk_level: str) -> Recommendation:
+        # Every field is computed here or taken from our own AI output, so skip
+        # validation; all required Recommendation fields must be passed explicitly
+        return Recommendation.model_construct(
+            id=uuid.uuid4(),
             query_hash=analysis.query_hash,
-            recommendation_type="index",
-            title="Add Index",
-            description="Consider adding an index to improve query performance.",
-            sql_fix=None,
-            estimated_improvement_percent=estimate_improvement(analysis),
-            confidence_score=score_recommendation(analysis),
-            risk_level="low",
+            recommendation_type=recommendation_type,
+            title=title,
+            description=description,
+            sql_fix=sql_fix,
+            estimated_improvement_percent=improvement,
+            confidence_score=confidence,
+            risk_level=risk_level,
             applied=False,
-            created_at=datetime.utcnow()
-        ))
+            created_at=now
+        )
+    
+    recs: List[Recommendation] = []
+    # Heuristic recommendations
+    if analysis.bottleneck_type in INDEX_BOTTLENECKS:
+        recs.append(_mk("index", "Add Index",
+                        "Consider adding an index to improve query performance.", None, "low"))
     if analysis.bottleneck_type == "large_sort":
-        recs.append(Recommendation(
-            id=str(uuid.uuid4()),
-            query_hash=analysis.query_hash,
-            recommendation_type="index",
-            title="Add Index for Sort",
-            description="Consider adding an index to optimize ORDER BY performance.",
-            sql_fix=None,
-            estimated_improvement_percent=estimate_improvement(analysis),
-            confidence_score=score_recommendation(analysis),
-            risk_level="low",
-            applied=False,
-            created_at=datetime.utcnow()
-        ))
+        recs.append(_mk("index", "Add Index for Sort",
+                        "Consider adding an index to optimize ORDER BY performance.", None, "low"))
     # AI-powered recommendation
-    ai_rec = await generate_recommendation({
+    query_data = {
         "query_text": analysis.query_text,
         "bottleneck_type": analysis.bottleneck_type,
         "performance_score": analysis.performance_score,
         "summary": analysis.analysis_summary
-    })
-    recs.append(Recommendation(
-        id=str(uuid.uuid4()),
-        query_hash=analysis.query_hash,
-        recommendation_type="ai",
-        title=ai_rec.get("title", "AI Recommendation"),
-        description=ai_rec.get("description", ""),
-        sql_fix=ai_rec.get("sql_fix"),
-        estimated_improvement_percent=estimate_improvement(analysis),
-        confidence_score=score_recommendation(analysis),
-        risk_level="medium",
-        applied=False,
-        created_at=datetime.utcnow()
-    ))
+    }
+    if analysis.execution_plan:
+        # Lets generate_recommendation skip the LLM for clean, fast plans
+        query_data["bottlenecks"] = analysis.execution_plan.bottlenecks
+        query_data["execution_time"] = analysis.execution_plan.execution_time
+    
+    # The recommendation and the rewrite are independent LLM calls, so run them together
+    wants_rewrite = analysis.bottleneck_type in REWRITE_BOTTLENECKS
+    if wants_rewrite:
+        ai_rec, optimized_sql = await asyncio.gather(
+            generate_recommendation(query_data),
+            rewrite_query(analysis.query_text),
+            return_exceptions=True
+        )
+    else:
+        ai_rec = await generate_recommendation(query_data)
+    if isinstance(ai_rec, BaseException):
+        raise ai_rec
+    recs.append(_mk("ai", ai_rec.get("title", "AI Recommendation"),
+                    ai_rec.get("description", ""), ai_rec.get("sql_fix"), "medium"))
     # Query rewrite suggestion (AI)
-    if analysis.bottleneck_type in ("sequential_scan", "large_sort", "inefficient_select"):
-        try:
-            optimized_sql = await rewrite_query(analysis.query_text)
-            if optimized_sql and optimized_sql != analysis.query_text:
-                recs.append(Recommendation(
-                    id=str(uuid.uuid4()),
-                    query_hash=analysis.query_hash,
-                    recommendation_type="rewrite",
-                    title="Rewrite Query",
-                    description="AI-optimized query for better performance.",
-                    sql_fix=optimized_sql,
-                    estimated_improvement_percent=estimate_improvement(analysis),
-                    confidence_score=score_recommendation(analysis),
-                    risk_level="medium",
-                    applied=False,
-                    created_at=datetime.utcnow()
-                ))
-        except Exception as e:
-            logger.warning(f"Query rewrite failed: {e}")
+    if wants_rewrite:
+        if isinstance(optimized_sql, BaseException):
+            logger.warning(f"Query rewrite failed: {optimized_sql}")
+        elif optimized_sql and optimized_sql != analysis.query_text:
+            recs.append(_mk("rewrite", "Rewrite Query",
+                            "AI-optimized query for better performance.", optimized_sql, "medium"))
     return recs
 
 
 async def generate_recommendations(analyses: List[AnalysisResult]) -> List[Recommendation]:
     """
     Generate recommendations for a list of analysis results.
+    Analyses are processed concurrently, at most OPENAI_MAX_CONCURRENCY at a time.
+    An analysis that fails is logged and contributes no recommendations.
     """
+    semaphore = _get_llm_semaphore()
+    
+    async def limited(analysis: AnalysisResult) -> List[Recommendation]:
+        async with semaphore:
+            return await generate_recommendations_for_analysis(analysis)
+    
+    results = await asyncio.gather(*(limited(a) for a in analyses), return_exceptions=True)
     all_recs: List[Recommendation] = []
-    for analysis in analyses:
-        recs = await generate_recommendations_for_analysis(analysis)
-        all_recs.extend(recs)
+    for analysis, result in zip(analyses, results):
+        if isinstance(result, BaseException):
+            logger.error(f"Recommendation generation failed for {analysis.query_hash}: {result}")
+            continue
+        all_recs.extend(result)
     return all_recs
 
 
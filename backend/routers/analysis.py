@@ -3,13 +3,23 @@ Analysis router for OptiSchema backend.
 Provides endpoints for query analysis and analysis status.
 """
 
-from fastapi import APIRouter, HTTPException
-from typing import Dict, Any, Optional
+import logging
+import re
+from collections import namedtuple
+from functools import lru_cache
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import Dict, Any, Optional, Tuple
 from pydantic import BaseModel
-from analysis.pipeline import get_analysis_cache, run_analysis_pipeline
+from analysis.pipeline import get_analysis_cache, get_analysis_cache_bytes, run_analysis_pipeline
 from analysis.core import analyze_queries
 from analysis.explain import execute_explain_plan, extract_plan_metrics
+from analysis.llm import generate_recommendation, rewrite_query, stream_explain_plan
+from collector import get_metrics_cache
 from db import get_pool
+from utils import query_hash
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/analysis", tags=["analysis"])
 
@@ -21,6 +31,11 @@ class QueryAnalysisRequest(BaseModel):
     optimize: bool = True
 
 
+class QueryExplainRequest(BaseModel):
+    """Request model for a streamed plan explanation."""
+    query: str
+
+
 class QueryAnalysisResponse(BaseModel):
     """Response model for query analysis."""
     query: str
@@ -32,7 +47,13 @@ class QueryAnalysisResponse(BaseModel):
 
 from utils import calculate_performance_score as unified_calculate_performance_score
 
-def calculate_performance_score(execution_plan: Optional[Dict[str, Any]], query_text: str) -> int:
+# Stand-in for HotQuery when scoring a single ad-hoc query
+_PlanHotQuery = namedtuple('_PlanHotQuery', [
+    'mean_time', 'calls', 'percentage_of_total_time', 'shared_blks_hit', 'shared_blks_read', 'rows'
+])
+
+def calculate_performance_score(execution_plan: Optional[Dict[str, Any]], query_text: str,
+                                plan_metrics: Optional[Dict[str, Any]] = None) -> int:
     """
     Calculate a performance score based on execution plan analysis.
     Now uses the unified calculation from utils.py for consistency.
@@ -40,27 +61,28 @@ def calculate_performance_score(execution_plan: Optional[Dict[str, Any]], query_
     Args:
         execution_plan: The execution plan from EXPLAIN
         query_text: The original query text
+        plan_metrics: Metrics already extracted from execution_plan, if available
         
     Returns:
         Performance score from 0-100
     """
-    if not execution_plan or execution_plan.get("error"):
+    if plan_metrics is None and (not execution_plan or execution_plan.get("error")):
         # If no execution plan, use basic heuristics
         return calculate_basic_score(query_text)
     
     try:
         # Extract metrics from execution plan
-        metrics = extract_plan_metrics(execution_plan)
+        metrics = plan_metrics if plan_metrics is not None else extract_plan_metrics(execution_plan)
         
         # Create a mock hot_query object for the unified calculation
-        hot_query = type('HotQuery', (), {
-            'mean_time': metrics.get('total_time', 0),
-            'calls': 1,  # Default for single query analysis
-            'percentage_of_total_time': 0,  # Not available in single query context
-            'shared_blks_hit': metrics.get('shared_hit_blocks', 0),
-            'shared_blks_read': metrics.get('shared_read_blocks', 0),
-            'rows': metrics.get('total_rows', 0)
-        })()
+        hot_query = _PlanHotQuery(
+            mean_time=metrics.get('total_time', 0),
+            calls=1,  # Default for single query analysis
+            percentage_of_total_time=0,  # Not available in single query context
+            shared_blks_hit=metrics.get('shared_hit_blocks', 0),
+            shared_blks_read=metrics.get('shared_read_blocks', 0),
+            rows=metrics.get('total_rows', 0)
+        )
         
         # Use the unified calculation
         return unified_calculate_performance_score(hot_query, execution_plan)
@@ -70,9 +92,30 @@ def calculate_performance_score(execution_plan: Optional[Dict[str, Any]], query_
         return calculate_basic_score(query_text)
 
 
+# Score adjustments for query features, matched case-insensitively anywhere in the text
+_BASIC_SCORE_WEIGHTS = {
+    'join': -10,          # Penalize complex operations
+    'group_by': -5,
+    'order_by': -5,
+    'distinct': -5,
+    'like': -5,
+    'limit': 5,           # Bonus for bounded result sets
+    'select_star': -10,   # Penalize SELECT *
+}
+_BASIC_SCORE_RE = re.compile(
+    r'(?P<join>JOIN)|(?P<group_by>GROUP BY)|(?P<order_by>ORDER BY)|(?P<distinct>DISTINCT)'
+    r'|(?P<like>LIKE)|(?P<limit>LIMIT)|(?P<select_star>SELECT \*)',
+    re.IGNORECASE
+)
+# Bonus for simple queries
+_SIMPLE_QUERY_RE = re.compile(r'SELECT COUNT\(\*\)|SELECT 1', re.IGNORECASE)
+
+
+@lru_cache(maxsize=4096)
 def calculate_basic_score(query_text: str) -> int:
     """
     Calculate a basic performance score based on query characteristics.
+    Results are memoized since ORM-generated query texts repeat heavily.
     
     Args:
         query_text: The query text
@@ -82,82 +125,47 @@ def calculate_basic_score(query_text: str) -> int:
     """
     score = 75  # Base score
     
-    query_upper = query_text.upper()
-    
-    # Penalize complex operations
-    if 'JOIN' in query_upper:
-        score -= 10
-    if 'GROUP BY' in query_upper:
-        score -= 5
-    if 'ORDER BY' in query_upper:
-        score -= 5
-    if 'DISTINCT' in query_upper:
-        score -= 5
-    if 'LIKE' in query_upper:
-        score -= 5
+    # One pass over the text collects every feature present; each counts once
+    features = {match.lastgroup for match in _BASIC_SCORE_RE.finditer(query_text)}
+    score += sum(_BASIC_SCORE_WEIGHTS[feature] for feature in features)
     
-    # Bonus for simple queries
-    if query_upper.startswith('SELECT COUNT(*)') or query_upper.startswith('SELECT 1'):
+    if _SIMPLE_QUERY_RE.match(query_text):
         score += 10
-    if 'LIMIT' in query_upper:
-        score += 5
-    
-    # Penalize SELECT *
-    if 'SELECT *' in query_upper:
-        score -= 10
     
     return max(0, min(100, score))
 
 
-def detect_bottleneck_type(execution_plan: Optional[Dict[str, Any]], query_text: str) -> str:
+def detect_bottleneck_type(execution_plan: Optional[Dict[str, Any]], query_text: str,
+                           plan_metrics: Optional[Dict[str, Any]] = None) -> str:
     """
     Detect the main bottleneck type based on execution plan and query text.
     
     Args:
         execution_plan: The execution plan from EXPLAIN
         query_text: The original query text
+        plan_metrics: Metrics already extracted from execution_plan, if available
         
     Returns:
         Bottleneck type description
     """
     # First, try to detect based on query text patterns
-    query_upper = query_text.upper()
-    
-    # Check for cursor operations
-    if 'MOVE ALL' in query_upper or 'FETCH ALL' in query_upper:
-        return "cursor_inefficiency"
-    
-    # Check for SELECT *
-    if 'SELECT *' in query_upper:
-        return "inefficient_select"
-    
-    # Check for complex operations
-    if 'JOIN' in query_upper and query_upper.count('JOIN') > 2:
-        return "complex_joins"
-    
-    if 'GROUP BY' in query_upper and 'ORDER BY' in query_upper:
-        return "sort_operation"
-    
-    if 'DISTINCT' in query_upper:
-        return "distinct_operation"
-    
-    if 'LIKE' in query_upper and '%' in query_text:
-        return "pattern_matching"
+    text_type, fallback_type = _text_bottleneck_types(query_text)
+    if text_type:
+        return text_type
     
     # If we have execution plan, use it for more detailed analysis
-    if execution_plan and not execution_plan.get("error"):
+    if plan_metrics is not None or (execution_plan and not execution_plan.get("error")):
         try:
-            metrics = extract_plan_metrics(execution_plan)
-            nodes = metrics.get('nodes', [])
+            metrics = plan_metrics if plan_metrics is not None else extract_plan_metrics(execution_plan)
+            # Counted during the plan traversal, so no extra pass over the nodes
+            node_type_counts = metrics.get('node_type_counts', {})
             
             # Check for sequential scans
-            seq_scans = sum(1 for node in nodes if node.get('node_type') == 'Seq Scan')
-            if seq_scans > 0:
+            if node_type_counts.get('Seq Scan'):
                 return "sequential_scan"
             
             # Check for large sorts
-            sorts = sum(1 for node in nodes if node.get('node_type') == 'Sort')
-            if sorts > 0:
+            if node_type_counts.get('Sort'):
                 return "sort_operation"
             
             # Check for slow execution
@@ -177,22 +185,67 @@ def detect_bottleneck_type(execution_plan: Optional[Dict[str, Any]], query_text:
         except Exception:
             pass
     
+    return fallback_type
+
+
+@lru_cache(maxsize=4096)
+def _text_bottleneck_types(query_text: str) -> Tuple[Optional[str], str]:
+    """
+    Classify a query from its text alone.
+    Memoized since it only depends on the text; plans carry per-run timings
+    and are not worth caching.
+    
+    Args:
+        query_text: The original query text
+        
+    Returns:
+        Tuple of (bottleneck type that takes precedence over the plan, or None;
+        fallback type when no usable plan is available)
+    """
+    query_upper = query_text.upper()
+    
     # Fallback based on query characteristics
     if 'JOIN' in query_upper:
-        return "join_optimization"
+        fallback_type = "join_optimization"
     elif 'WHERE' in query_upper:
-        return "filter_optimization"
+        fallback_type = "filter_optimization"
     else:
-        return "general_optimization"
+        fallback_type = "general_optimization"
+    
+    # Check for cursor operations
+    if 'MOVE ALL' in query_upper or 'FETCH ALL' in query_upper:
+        return "cursor_inefficiency", fallback_type
+    
+    # Check for SELECT *
+    if 'SELECT *' in query_upper:
+        return "inefficient_select", fallback_type
+    
+    # Check for complex operations
+    if 'JOIN' in query_upper and query_upper.count('JOIN') > 2:
+        return "complex_joins", fallback_type
+    
+    if 'GROUP BY' in query_upper and 'ORDER BY' in query_upper:
+        return "sort_operation", fallback_type
+    
+    if 'DISTINCT' in query_upper:
+        return "distinct_operation", fallback_type
+    
+    if 'LIKE' in query_upper and '%' in query_text:
+        return "pattern_matching", fallback_type
+    
+    return None, fallback_type
 
 
 @router.get("/latest")
-async def get_latest_analysis() -> Dict[str, Any]:
-    """Return the latest analysis results."""
-    analysis_results = get_analysis_cache()
-    if not analysis_results:
+async def get_latest_analysis() -> Response:
+    """
+    Return the latest analysis results.
+    The pipeline serializes its results once per run, so polling this
+    endpoint only copies the cached bytes.
+    """
+    if not get_analysis_cache():
         raise HTTPException(status_code=404, detail="No analysis results available")
-    return analysis_results
+    return Response(content=get_analysis_cache_bytes(), media_type="application/json")
 
 
 @router.post("/run")
@@ -210,28 +263,43 @@ async def run_analysis() -> Dict[str, Any]:
 
 
 @router.post("/query", response_model=QueryAnalysisResponse)
-async def analyze_query(request: QueryAnalysisRequest) -> QueryAnalysisResponse:
-    """Analyze a specific query."""
+async def analyze_query(request: QueryAnalysisRequest) -> ORJSONResponse:
+    """
+    Analyze a specific query.
+    
+    The response is built from server-side data only, so it is assembled with
+    model_construct and returned directly, skipping FastAPI's response
+    validation. response_model is kept for the OpenAPI schema.
+    """
     try:
-        pool = get_pool()
+        pool = await get_pool()
         if not pool:
             raise HTTPException(status_code=500, detail="Database connection not available")
         
-        response = QueryAnalysisResponse(query=request.query)
+        execution_plan = None
+        optimization = None
         
         # Get execution plan if requested
         if request.explain:
             try:
-                plan = await execute_explain_plan(request.query)
-                response.execution_plan = plan
+                execution_plan = await execute_explain_plan(request.query)
             except Exception as e:
                 # Plan analysis failed, but continue with other analysis
-                response.execution_plan = {"error": str(e)}
+                execution_plan = {"error": str(e)}
+        
+        # Extract plan metrics once; scoring, bottleneck detection and the
+        # recommendation all read from them
+        plan_metrics = None
+        if execution_plan and "error" not in execution_plan:
+            try:
+                plan_metrics = extract_plan_metrics(execution_plan)
+            except Exception as e:
+                logger.error(f"Error extracting plan metrics: {e}")
         
         # Calculate performance score and detect bottlenecks
         try:
-            performance_score = calculate_performance_score(response.execution_plan, request.query)
-            bottleneck_type = detect_bottleneck_type(response.execution_plan, request.query)
+            performance_score = calculate_performance_score(execution_plan, request.query, plan_metrics)
+            bottleneck_type = detect_bottleneck_type(execution_plan, request.query, plan_metrics)
         except Exception as e:
             logger.error(f"Error calculating performance metrics: {e}")
             performance_score = 50  # Default score
@@ -240,36 +308,30 @@ async def analyze_query(request: QueryAnalysisRequest) -> QueryAnalysisResponse:
         # Analyze the query
         analysis_result = {
             "query_text": request.query,
-            "query_hash": hash(request.query),
+            "query_hash": query_hash(request.query),
             "analysis_summary": "Query analysis completed",
             "performance_score": performance_score,
             "bottleneck_type": bottleneck_type
         }
-        response.analysis = analysis_result
         
         # Generate optimization if requested
         if request.optimize:
             try:
-                from analysis.llm import rewrite_query
-                optimized = await rewrite_query(request.query)
-                response.optimization = optimized
+                optimization = await rewrite_query(request.query)
             except Exception as e:
-                response.optimization = f"Optimization failed: {str(e)}"
+                optimization = f"Optimization failed: {str(e)}"
         
         # Generate recommendations
         try:
-            from analysis.llm import generate_recommendation
-            from collector import get_metrics_cache
-            
             # Try to find actual metrics for this query
             try:
                 metrics_cache = get_metrics_cache()
                 actual_metrics = None
-                if metrics_cache and isinstance(metrics_cache, list):
+                if metrics_cache and isinstance(metrics_cache, (list, tuple)):
                     # Look for matching query in metrics cache
-                    query_hash = str(hash(request.query))
+                    request_hash = query_hash(request.query)
                     for metric in metrics_cache:
-                        if hasattr(metric, 'query_hash') and metric.query_hash == query_hash:
+                        if hasattr(metric, 'query_hash') and metric.query_hash == request_hash:
                             actual_metrics = {
                                 "total_time": metric.total_time,
                                 "calls": metric.calls,
@@ -294,20 +356,50 @@ async def analyze_query(request: QueryAnalysisRequest) -> QueryAnalysisResponse:
             query_data = {
                 "query_text": request.query,
                 "analysis": analysis_result,
-                "execution_plan": response.execution_plan,
+                "execution_plan": execution_plan,
                 "actual_metrics": actual_metrics  # Include actual metrics if available
             }
-            recommendation = await generate_recommendation(query_data)
-            response.recommendations = recommendation
+            if plan_metrics is not None:
+                # Lets generate_recommendation skip the LLM for clean, fast plans
+                query_data["bottlenecks"] = plan_metrics.get("bottlenecks")
+                query_data["execution_time"] = plan_metrics.get("execution_time")
+            recommendations = await generate_recommendation(query_data)
         except Exception as e:
-            response.recommendations = {"error": str(e)}
+            recommendations = {"error": str(e)}
         
-        return response
+        response = QueryAnalysisResponse.model_construct(
+            query=request.query,
+            execution_plan=execution_plan,
+            analysis=analysis_result,
+            optimization=optimization,
+            recommendations=recommendations
+        )
+        return ORJSONResponse(response.__dict__)
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Query analysis failed: {str(e)}")
 
 
+@router.post("/explain/stream")
+async def stream_query_explanation(request: QueryExplainRequest) -> StreamingResponse:
+    """
+    Explain a query's execution plan, streaming the LLM's explanation as
+    plain text while it is generated instead of waiting for all of it.
+    """
+    pool = await get_pool()
+    if not pool:
+        raise HTTPException(status_code=500, detail="Database connection not available")
+    
+    execution_plan = await execute_explain_plan(request.query)
+    if not execution_plan:
+        raise HTTPException(status_code=400, detail="Failed to generate execution plan")
+    
+    return StreamingResponse(
+        stream_explain_plan(execution_plan, request.query),
+        media_type="text/plain"
+    )
+
+
 @router.get("/status")
 async def get_analysis_status() -> Dict[str, Any]:
     """Get the current analysis status."""
@@ -1,4 +1,5 @@
 from fastapi import APIRouter, HTTPException, Depends
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import asyncpg
 import asyncio
@@ -6,12 +7,14 @@ import logging
 from typing import Optional, Dict, Any
 from datetime import datetime
 
+from config import parse_database_url
 from connection_manager import connection_manager
 from db import get_pool
+from sql import SQL_PG_STAT_COUNT, SQL_PG_STAT_ENABLED
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter()
+router = APIRouter(default_response_class=ORJSONResponse)
 
 class ConnectionTestRequest(BaseModel):
     host: Optional[str] = None
@@ -40,48 +43,16 @@ class ConnectionSwitchRequest(BaseModel):
     password: str
     ssl: Optional[bool] = False
 
-@router.post("/test", response_model=ConnectionTestResponse)
-async def test_connection(request: ConnectionTestRequest):
-    """Test database connection and check for pg_stat_statements extension."""
+def _request_config(request: ConnectionTestRequest) -> Dict[str, Any]:
+    """
+    Build a connection config from a connection string or individual fields.
     
-    # Parse connection string or build from components
+    Raises:
+        ValueError: If the connection string or port is invalid
+    """
     if request.connection_string:
-        # For connection string, we need to parse it to get config
-        try:
-            # Simple parsing - in production, use proper URL parsing
-            url = request.connection_string
-            if url.startswith("postgresql://"):
-                parts = url.replace("postgresql://", "").split("@")
-                if len(parts) == 2:
-                    auth, rest = parts
-                    user_pass = auth.split(":")
-                    host_port_db = rest.split("/")
-                    if len(host_port_db) == 2:
-                        host_port, db = host_port_db
-                        host_port_parts = host_port.split(":")
-                        host = host_port_parts[0]
-                        port = int(host_port_parts[1]) if len(host_port_parts) > 1 else 5432
-                        user = user_pass[0]
-                        password = user_pass[1] if len(user_pass) > 1 else ""
-                        
-                        config = {
-                            "host": host,
-                            "port": port,
-                            "database": db,
-                            "user": user,
-                            "password": password
-                        }
-                    else:
-                        raise ValueError("Invalid connection string format")
-                else:
-                    raise ValueError("Invalid connection string format")
-            else:
-                raise ValueError("Invalid connection string format")
-        except Exception as e:
-            return ConnectionTestResponse(
-                success=False,
-                message=f"Invalid connection string: {str(e)}"
-            )
+        # Parsed URLs are cached, so repeated submissions are cheap
+        config = parse_database_url(request.connection_string)
     else:
         # Build config from individual components
         config = {
@@ -91,10 +62,24 @@ async def test_connection(request: ConnectionTestRequest):
             "user": request.username or "postgres",
             "password": request.password or ""
         }
+    config["ssl"] = request.ssl
+    return config
+
+@router.post("/test", response_model=ConnectionTestResponse)
+async def test_connection(request: ConnectionTestRequest):
+    """Test database connection and check for pg_stat_statements extension."""
+    
+    try:
+        config = _request_config(request)
+    except ValueError as e:
+        return ConnectionTestResponse(
+            success=False,
+            message=f"Invalid connection string: {str(e)}"
+        )
     
-    # Test the connection using the connection manager
+    # Test the connection using the connection manager (trusted result, no re-validation)
     result = await connection_manager.test_connection(config)
-    return ConnectionTestResponse(**result)
+    return ConnectionTestResponse.model_construct(**result)
 
 @router.post("/switch", response_model=ConnectionTestResponse)
 async def switch_database(request: ConnectionSwitchRequest):
@@ -108,11 +93,15 @@ async def switch_database(request: ConnectionSwitchRequest):
         "password": request.password,
         "ssl": request.ssl
     }
+    return await _switch_connection(config)
+
+async def _switch_connection(config: Dict[str, Any]) -> ConnectionTestResponse:
+    """Test a connection config and, if it works, make it the active connection."""
     
     # Test the connection first
     test_result = await connection_manager.test_connection(config)
     if not test_result['success']:
-        return ConnectionTestResponse(**test_result)
+        return ConnectionTestResponse.model_construct(**test_result)
     
     # Switch to the new connection
     success = await connection_manager.connect(config)
@@ -140,15 +129,15 @@ async def get_connection_status():
     
     # If not connected, return empty history to keep things clean
     if not is_healthy:
-        return ConnectionStatusResponse(
+        return ConnectionStatusResponse.model_construct(
             connected=False,
             current_config=None,
             connection_history=[]
         )
     
-    return ConnectionStatusResponse(
+    return ConnectionStatusResponse.model_construct(
         connected=True,
-        current_config=current_config,
+        current_config=dict(current_config),
         connection_history=history
     )
 
@@ -186,50 +175,13 @@ async def connect_database(request: ConnectionTestRequest):
             detail="Either connection_string or host, database, and username are required"
         )
     
-    # Convert to switch request format
-    if request.connection_string:
-        # Parse connection string
-        url = request.connection_string
-        if url.startswith("postgresql://"):
-            parts = url.replace("postgresql://", "").split("@")
-            if len(parts) == 2:
-                auth, rest = parts
-                user_pass = auth.split(":")
-                host_port_db = rest.split("/")
-                if len(host_port_db) == 2:
-                    host_port, db = host_port_db
-                    host_port_parts = host_port.split(":")
-                    host = host_port_parts[0]
-                    port = host_port_parts[1] if len(host_port_parts) > 1 else "5432"
-                    user = user_pass[0]
-                    password = user_pass[1] if len(user_pass) > 1 else ""
-                    
-                    switch_request = ConnectionSwitchRequest(
-                        host=host,
-                        port=port,
-                        database=db,
-                        username=user,
-                        password=password,
-                        ssl=request.ssl
-                    )
-                else:
-                    raise HTTPException(status_code=400, detail="Invalid connection string")
-            else:
-                raise HTTPException(status_code=400, detail="Invalid connection string")
-        else:
-            raise HTTPException(status_code=400, detail="Invalid connection string")
-    else:
-        switch_request = ConnectionSwitchRequest(
-            host=request.host or "localhost",
-            port=request.port or "5432",
-            database=request.database or "postgres",
-            username=request.username or "postgres",
-            password=request.password or "",
-            ssl=request.ssl
-        )
+    try:
+        config = _request_config(request)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid connection string")
     
-    # Use the switch endpoint
-    return await switch_database(switch_request) 
+    # Same path as the switch endpoint
+    return await _switch_connection(config)
 
 @router.post("/enable-pg-stat")
 async def enable_pg_stat_statements() -> Dict[str, Any]:
@@ -268,22 +220,13 @@ async def get_pg_stat_statements_info() -> Dict[str, Any]:
                 return {"available": False, "error": "pg_stat_statements extension not available"}
             
             # Check if it's enabled
-            enabled = await conn.fetchval("""
-                SELECT EXISTS(
-                    SELECT 1 FROM pg_extension 
-                    WHERE extname = 'pg_stat_statements'
-                )
-            """)
+            enabled = await conn.fetchval(SQL_PG_STAT_ENABLED)
             
             if not enabled:
                 return {"available": True, "enabled": False, "error": "pg_stat_statements not enabled"}
             
             # Get statistics
-            total_queries = await conn.fetchval("""
-                SELECT COUNT(*) as total_queries 
-                FROM pg_stat_statements
-                WHERE query NOT ILIKE 'EXPLAIN%' AND query NOT ILIKE 'DEALLOCATE%'
-            """)
+            total_queries = await conn.fetchval(SQL_PG_STAT_COUNT)
             
             # Get configuration
             max_config = await conn.fetchval(
@@ -314,10 +257,8 @@ async def reset_pg_stat_statements() -> Dict[str, Any]:
         if not pool:
             raise HTTPException(status_code=500, detail="No database connection available")
         
-        async with pool.acquire() as conn:
-            # Check if user has permissions
-            await conn.execute("SELECT pg_stat_statements_reset()")
-            
+        await pool.execute("SELECT pg_stat_statements_reset()")
+        
         logger.info("pg_stat_statements reset successfully")
         return {
             "success": True,
@@ -3,21 +3,158 @@ Metrics router for OptiSchema backend.
 Provides endpoints for query metrics and performance data.
 """
 
+import asyncio
+import heapq
+import numpy as np
+import orjson
 from fastapi import APIRouter, HTTPException, Query
-from typing import List, Dict, Any, Optional
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from typing import AsyncIterator, List, Dict, Any, Optional, Callable, Literal, Sequence, Tuple
 from datetime import datetime, timedelta
 from analysis.core import calculate_performance_metrics, identify_hot_queries
-from collector import get_metrics_cache
+from collector import (
+    get_metrics_cache, get_metrics_columns, build_metrics_columns,
+    get_metrics_cache_dicts, build_metrics_dicts, get_metrics_cache_version
+)
 from connection_manager import connection_manager
+from db import _CachedHealthCheck
 
-router = APIRouter(prefix="/metrics", tags=["metrics"])
+router = APIRouter(prefix="/metrics", tags=["metrics"], default_response_class=ORJSONResponse)
+
+# Fields /raw and /top can sort by; FastAPI rejects anything else with a 422
+RawSortField = Literal["total_time", "mean_time", "calls", "rows", "time_percentage", "performance_score"]
+TopSortField = Literal["total_time", "mean_time", "calls", "rows"]
+
+# Data derived from a metrics snapshot: name -> (snapshot version, value)
+_derived_cache: Dict[str, Tuple[int, Any]] = {}
+
+
+def _derived(name: str, build: Callable[[], Any]) -> Any:
+    """
+    Return build() for the current metrics snapshot, memoized until the
+    collector publishes a new one. Cached values are shared between
+    requests and must not be mutated.
+    """
+    version = get_metrics_cache_version()
+    entry = _derived_cache.get(name)
+    if entry is None or entry[0] != version:
+        entry = (version, build())
+        _derived_cache[name] = entry
+    return entry[1]
+
+
+def _metrics_dicts() -> Sequence[Dict[str, Any]]:
+    """The current metrics snapshot as JSON-ready dictionaries (built by the collector)."""
+    return get_metrics_cache_dicts() or _derived('dicts', lambda: build_metrics_dicts(get_metrics_cache()))
+
+
+# Records serialized to estimate the average size of a metric
+SIZE_SAMPLE_COUNT = 32
+
+
+def _estimate_size_mb() -> float:
+    """Estimate the JSON size of the current metrics snapshot from an evenly spaced sample."""
+    metrics = get_metrics_cache()
+    if not metrics:
+        return 0.0
+    sample = metrics[::max(1, len(metrics) // SIZE_SAMPLE_COUNT)][:SIZE_SAMPLE_COUNT]
+    avg_bytes = sum(len(metric.model_dump_json()) for metric in sample) / len(sample)
+    return len(metrics) * avg_bytes / 1024 / 1024
+
+
+def _metrics_size_mb() -> float:
+    """Estimated size of the current metrics snapshot serialized as JSON, in MB."""
+    return _derived('size_mb', _estimate_size_mb)
+
+
+# Length of the lowercased substrings indexed for /raw search
+SEARCH_NGRAM = 4
+
+# n-gram index of the most recently searched snapshot: (snapshot version, index)
+_search_index: Optional[Tuple[int, Dict[str, List[int]]]] = None
+
+
+def _build_search_index(texts: Sequence[str]) -> Dict[str, List[int]]:
+    """Map every SEARCH_NGRAM-character substring of texts to the (ascending) rows containing it."""
+    index: Dict[str, List[int]] = {}
+    n = SEARCH_NGRAM
+    for row, text in enumerate(texts):
+        for gram in {text[i:i + n] for i in range(len(text) - n + 1)}:
+            postings = index.get(gram)
+            if postings is None:
+                index[gram] = [row]
+            else:
+                postings.append(row)
+    return index
+
+
+def _search_mask(texts: Sequence[str], needle: str, version: int) -> np.ndarray:
+    """
+    Boolean mask of the rows whose lowercased text contains needle.
+    
+    Needles of at least SEARCH_NGRAM characters are narrowed down with an
+    n-gram index of texts (built on the first search of snapshot version),
+    so only rows containing every n-gram of the needle get a substring check.
+    Runs in a worker thread, so the index is keyed by the version texts
+    came from rather than whatever snapshot is current by then.
+    """
+    global _search_index
+    n = SEARCH_NGRAM
+    if len(needle) < n:
+        return np.fromiter((needle in text for text in texts), dtype=bool, count=len(texts))
+    
+    cached = _search_index
+    if cached is not None and cached[0] == version:
+        index = cached[1]
+    else:
+        index = _build_search_index(texts)
+        _search_index = (version, index)
+    postings = sorted((index.get(needle[i:i + n], ()) for i in range(len(needle) - n + 1)), key=len)
+    candidates = set(postings[0])
+    for rows in postings[1:]:
+        if not candidates:
+            break
+        candidates.intersection_update(rows)
+    
+    mask = np.zeros(len(texts), dtype=bool)
+    mask[[row for row in candidates if needle in texts[row]]] = True
+    return mask
+
+
+# /raw pages with more records than this are streamed in batches
+STREAM_THRESHOLD = 1000
+STREAM_BATCH_SIZE = 250
+
+
+async def _stream_raw_page(queries: List[Dict[str, Any]], pagination: Dict[str, Any],
+                           filters: Dict[str, Any]) -> AsyncIterator[bytes]:
+    """
+    Encode a /raw response incrementally, one batch of records at a time,
+    so only a single batch's JSON is held in memory. The output matches
+    ORJSONResponse for the same payload byte for byte.
+    """
+    yield b'{"queries":['
+    for start in range(0, len(queries), STREAM_BATCH_SIZE):
+        batch = orjson.dumps(queries[start:start + STREAM_BATCH_SIZE])[1:-1]
+        yield batch if start == 0 else b',' + batch
+    yield b'],"pagination":' + orjson.dumps(pagination) + b',"filters":' + orjson.dumps(filters) + b'}'
+
+
+# Seconds a connection health probe is reused across /raw requests
+RAW_HEALTH_CHECK_TTL = 2.0
+
+# Connection health shared across requests, so polling clients don't each
+# issue a SELECT 1; switching connections invalidates the cached result
+_cached_health = _CachedHealthCheck(
+    connection_manager.check_connection_health, RAW_HEALTH_CHECK_TTL, scope=connection_manager.get_pool
+)
 
 
 @router.get("/raw")
 async def get_raw_metrics(
     limit: int = Query(100, ge=1, le=5000, description="Number of queries to return"),
     offset: int = Query(0, ge=0, description="Number of queries to skip"),
-    sort_by: str = Query("total_time", description="Field to sort by"),
+    sort_by: RawSortField = Query("total_time", description="Field to sort by"),
     order: str = Query("desc", regex="^(asc|desc)$", description="Sort order"),
     min_calls: int = Query(1, ge=1, description="Minimum number of calls"),
     min_time: float = Query(0.0, ge=0.0, description="Minimum mean execution time (ms)"),
@@ -25,7 +162,7 @@ async def get_raw_metrics(
 ) -> Dict[str, Any]:
     """Return paginated query metrics with filtering and sorting."""
     # Check if we're connected to a database
-    is_connected = await connection_manager.check_connection_health()
+    is_connected = await _cached_health()
     if not is_connected:
         return {
             "queries": [],
@@ -49,56 +186,57 @@ async def get_raw_metrics(
             }
         }
     
-    # Convert Pydantic models to dictionaries
-    metrics_data = [metric.model_dump() if hasattr(metric, 'model_dump') else metric for metric in metrics]
+    # Filter and sort on the columnar view; only the returned page is
+    # materialized as dictionaries (built once per metrics snapshot). Take
+    # the columns and dictionaries of the same snapshot before awaiting, so a
+    # refresh during the search can't mix row indexes of two snapshots.
+    version = get_metrics_cache_version()
+    columns = get_metrics_columns() or build_metrics_columns(metrics)
+    metrics_data = _metrics_dicts()
     
     # Apply filters
-    filtered_metrics = []
-    for metric in metrics_data:
-        # Filter by minimum calls
-        if metric.get('calls', 0) < min_calls:
-            continue
-            
-        # Filter by minimum time
-        if metric.get('mean_time', 0.0) < min_time:
-            continue
-            
-        # Filter by search term
-        if search and search.lower() not in metric.get('query_text', '').lower():
-            continue
-            
-        filtered_metrics.append(metric)
-    
-    # Validate sort_by parameter
-    valid_sort_fields = ["total_time", "mean_time", "calls", "rows", "time_percentage", "performance_score"]
-    if sort_by not in valid_sort_fields:
-        raise HTTPException(status_code=400, detail=f"Invalid sort_by. Must be one of: {valid_sort_fields}")
-    
-    # Sort metrics
-    reverse = order == "desc"
-    sorted_metrics = sorted(filtered_metrics, key=lambda x: x.get(sort_by, 0), reverse=reverse)
+    mask = (columns['calls'] >= min_calls) & (columns['mean_time'] >= min_time)
+    if search:
+        # Off the event loop: the first search of a snapshot builds its index
+        mask &= await asyncio.to_thread(_search_mask, columns['query_text_lower'], search.lower(), version)
+    selected = np.flatnonzero(mask)
+    
+    # Sort metrics (stable, so ties keep collection order as before)
+    values = columns[sort_by][selected]
+    if order == "desc":
+        values = -values
+    selected = selected[np.argsort(values, kind='stable')]
     
     # Apply pagination
-    total = len(sorted_metrics)
+    total = len(selected)
     start = offset
     end = offset + limit
-    paginated_metrics = sorted_metrics[start:end]
+    paginated_metrics = [metrics_data[i] for i in selected[start:end].tolist()]
+    
+    pagination = {
+        "total": total,
+        "limit": limit,
+        "offset": offset,
+        "has_more": end < total,
+        "returned": len(paginated_metrics)
+    }
+    filters = {
+        "min_calls": min_calls,
+        "min_time": min_time,
+        "search": search
+    }
     
-    return {
+    # Everything here is already JSON-ready, so skip jsonable_encoder
+    if len(paginated_metrics) > STREAM_THRESHOLD:
+        return StreamingResponse(
+            _stream_raw_page(paginated_metrics, pagination, filters),
+            media_type="application/json"
+        )
+    return ORJSONResponse({
         "queries": paginated_metrics,
-        "pagination": {
-            "total": total,
-            "limit": limit,
-            "offset": offset,
-            "has_more": end < total,
-            "returned": len(paginated_metrics)
-        },
-        "filters": {
-            "min_calls": min_calls,
-            "min_time": min_time,
-            "search": search
-        }
-    }
+        "pagination": pagination,
+        "filters": filters
+    })
 
 
 @router.get("/summary")
@@ -108,15 +246,16 @@ async def get_metrics_summary() -> Dict[str, Any]:
     if not metrics:
         raise HTTPException(status_code=404, detail="No metrics available")
     
-    summary = calculate_performance_metrics(metrics)
+    summary = _derived('summary', lambda: calculate_performance_metrics(metrics).model_dump(mode='json'))
     
     # Add data size information
-    summary["data_size"] = {
-        "total_queries": len(metrics),
-        "cache_size_mb": len(str(metrics)) / 1024 / 1024  # Rough estimate
+    return {
+        **summary,
+        "data_size": {
+            "total_queries": len(metrics),
+            "cache_size_mb": _metrics_size_mb()
+        }
     }
-    
-    return summary
 
 
 @router.get("/hot")
@@ -127,29 +266,26 @@ async def get_hot_queries(limit: int = Query(10, ge=1, le=100)) -> List[Dict[str
         return []
     
     hot_queries = identify_hot_queries(metrics, limit=limit)
-    # Convert Pydantic models to dictionaries
-    return [query.model_dump() if hasattr(query, 'model_dump') else query for query in hot_queries]
+    # identify_hot_queries always returns HotQuery models
+    return [query.model_dump() for query in hot_queries]
 
 
 @router.get("/top")
 async def get_top_queries(
     limit: int = Query(10, ge=1, le=100), 
-    sort_by: str = Query("total_time")
+    sort_by: TopSortField = Query("total_time")
 ) -> List[Dict[str, Any]]:
     """Return top queries sorted by specified criteria."""
     metrics = get_metrics_cache()
     if not metrics:
         return []
     
-    # Validate sort_by parameter
-    valid_sort_fields = ["total_time", "mean_time", "calls", "rows"]
-    if sort_by not in valid_sort_fields:
-        raise HTTPException(status_code=400, detail=f"Invalid sort_by. Must be one of: {valid_sort_fields}")
-    
-    # Sort metrics by the specified field
-    sorted_metrics = sorted(metrics, key=lambda x: x.get(sort_by, 0), reverse=True)
-    # Convert Pydantic models to dictionaries
-    return [metric.model_dump() if hasattr(metric, 'model_dump') else metric for metric in sorted_metrics[:limit]]
+    # Select the top entries by the specified field without sorting everything
+    columns = get_metrics_columns() or build_metrics_columns(metrics)
+    values = columns[sort_by].tolist()
+    top = heapq.nlargest(limit, range(len(values)), key=values.__getitem__)
+    metrics_data = _metrics_dicts()
+    return [metrics_data[i] for i in top]
 
 
 @router.get("/stats")
@@ -166,12 +302,13 @@ async def get_collection_stats() -> Dict[str, Any]:
         }
     
     # Calculate statistics
+    columns = get_metrics_columns() or build_metrics_columns(metrics)
     total_queries = len(metrics)
-    total_calls = sum(m.calls if hasattr(m, 'calls') else m.get('calls', 0) for m in metrics)
-    total_time = sum(m.total_time if hasattr(m, 'total_time') else m.get('total_time', 0) for m in metrics)
+    total_calls = int(columns['calls'].sum())
+    total_time = int(columns['total_time'].sum())
     
-    # Estimate memory usage
-    memory_mb = len(str(metrics)) / 1024 / 1024
+    # Estimate memory usage from the serialized snapshot size
+    memory_mb = _metrics_size_mb()
     
     return {
         "total_queries": total_queries,
@@ -266,9 +403,11 @@ async def get_performance_trends() -> Dict[str, Any]:
         }
     
     # Calculate trends based on current metrics
+    columns = get_metrics_columns() or build_metrics_columns(metrics)
+    mean_times = columns['mean_time']
     total_queries = len(metrics)
-    avg_latency = sum(m.mean_time for m in metrics) / total_queries if total_queries > 0 else 0
-    slow_queries = len([m for m in metrics if m.mean_time > 100])
+    avg_latency = float(mean_times.mean()) if total_queries > 0 else 0
+    slow_queries = int(np.count_nonzero(mean_times > 100))
     
     # Generate trend insights
     trends = []
@@ -3,13 +3,61 @@ Suggestions router for OptiSchema backend.
 Provides endpoints for optimization recommendations.
 """
 
+import asyncio
+import logging
 from fastapi import APIRouter, HTTPException
-from typing import List, Dict, Any
-from analysis.pipeline import get_recommendations_cache, run_analysis_pipeline
+from fastapi.responses import ORJSONResponse
+from typing import Awaitable, Callable, List, Dict, Any, Tuple
+from analysis.pipeline import get_recommendations_cache, get_recommendations_index, get_recommendations_type_counts, run_analysis_pipeline
 from recommendations import apply_recommendation
 from sandbox import run_benchmark_test, get_sandbox_connection
 
-router = APIRouter(prefix="/suggestions", tags=["suggestions"])
+logger = logging.getLogger(__name__)
+
+# Recommendation types reported in the suggestions listing
+SUGGESTION_CATEGORIES = ("index", "query", "schema", "config")
+
+# Recommendation.recommendation_type -> listing category (other types, such
+# as free-form "ai" recommendations, count towards the total only)
+RECOMMENDATION_TYPE_CATEGORIES = {
+    "index": "index",
+    "rewrite": "query",
+    "schema": "schema",
+    "config": "config",
+}
+
+router = APIRouter(prefix="/suggestions", tags=["suggestions"], default_response_class=ORJSONResponse)
+
+
+# Apply/benchmark runs in progress, keyed by (operation, recommendation id)
+_inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+
+async def _coalesced(operation: str, recommendation_id: str, run: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Run an expensive operation once per recommendation at a time. Requests
+    arriving while it is in flight await the same task and share its
+    result (or exception) instead of starting a duplicate sandbox run.
+    """
+    key = (operation, str(recommendation_id))
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(run())
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+    # Shield so one cancelled request doesn't cancel the run for the others
+    return await asyncio.shield(task)
+
+
+def _find_recommendation(recommendation_id: str) -> Dict[str, Any]:
+    """Look up a cached recommendation by id, raising 404 if it is missing."""
+    recs = get_recommendations_index()
+    if not recs:
+        raise HTTPException(status_code=404, detail="No recommendations available")
+    recommendation = recs.get(str(recommendation_id))
+    if recommendation is None:
+        raise HTTPException(status_code=404, detail=f"Recommendation {recommendation_id} not found")
+    return recommendation
 
 
 @router.get("/latest")
@@ -24,16 +72,7 @@ async def get_latest_suggestions() -> List[Dict[str, Any]]:
 @router.get("/{recommendation_id}")
 async def get_specific_suggestion(recommendation_id: str) -> Dict[str, Any]:
     """Return a specific recommendation by ID."""
-    recs = get_recommendations_cache()
-    if recs is None or len(recs) == 0:
-        raise HTTPException(status_code=404, detail="No recommendations available")
-    
-    # Find the recommendation by ID
-    for rec in recs:
-        if rec.get("id") == recommendation_id:
-            return rec
-    
-    raise HTTPException(status_code=404, detail=f"Recommendation {recommendation_id} not found")
+    return _find_recommendation(recommendation_id)
 
 
 @router.post("/apply")
@@ -42,27 +81,10 @@ async def apply_suggestion(request: Dict[str, Any]) -> Dict[str, Any]:
     recommendation_id = request.get("recommendation_id")
     if not recommendation_id:
         raise HTTPException(status_code=400, detail="Missing recommendation_id")
-    recs = get_recommendations_cache()
-    if recs is None or len(recs) == 0:
-        raise HTTPException(status_code=404, detail="No recommendations available")
-    
-    # Find the recommendation by ID
-    recommendation = None
-    for rec in recs:
-        rec_id = rec.get("id")
-        # Convert UUID to string for comparison
-        if isinstance(rec_id, str) and rec_id == recommendation_id:
-            recommendation = rec
-            break
-        elif hasattr(rec_id, 'hex') and str(rec_id) == recommendation_id:
-            recommendation = rec
-            break
-    
-    if not recommendation:
-        raise HTTPException(status_code=404, detail=f"Recommendation {recommendation_id} not found")
+    recommendation = _find_recommendation(recommendation_id)
     
     try:
-        result = await apply_recommendation(recommendation)
+        result = await _coalesced("apply", recommendation_id, lambda: apply_recommendation(recommendation))
         return {
             "success": True,
             "message": f"Recommendation {recommendation_id} applied successfully",
@@ -79,43 +101,54 @@ async def benchmark_suggestion(request: Dict[str, Any]) -> Dict[str, Any]:
     if not recommendation_id:
         raise HTTPException(status_code=400, detail="Missing recommendation_id")
     
-    recs = get_recommendations_cache()
-    if recs is None or len(recs) == 0:
-        raise HTTPException(status_code=404, detail="No recommendations available")
-    
-    # Debug logging
-    import logging
-    logger = logging.getLogger(__name__)
     logger.info(f"Looking for recommendation ID: {recommendation_id}")
-    logger.info(f"Available recommendations: {[rec.get('id') for rec in recs]}")
-    
-    # Find the recommendation by ID
-    recommendation = None
-    for rec in recs:
-        rec_id = rec.get("id")
-        # Convert UUID to string for comparison
-        if isinstance(rec_id, str) and rec_id == recommendation_id:
-            recommendation = rec
-            break
-        elif hasattr(rec_id, 'hex') and str(rec_id) == recommendation_id:
-            recommendation = rec
-            break
-    
-    if not recommendation:
-        raise HTTPException(status_code=404, detail=f"Recommendation {recommendation_id} not found")
+    recommendation = _find_recommendation(recommendation_id)
     
     try:
         # Run benchmark test in sandbox
-        benchmark_result = await run_benchmark_test(recommendation)
-        return {
+        benchmark_result = await _coalesced("benchmark", recommendation_id, lambda: run_benchmark_test(recommendation))
+        # The result (including the nested EXPLAIN plans) is JSON-ready, so
+        # encode it with orjson directly rather than through the response model
+        return ORJSONResponse({
             "success": True,
             "message": f"Benchmark completed for recommendation {recommendation_id}",
             "benchmark": benchmark_result
-        }
+        })
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to run benchmark: {str(e)}")
 
 
+@router.post("/benchmark/batch")
+async def benchmark_suggestions(request: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run benchmark tests for several recommendations concurrently in sandbox.
+    
+    Each benchmark holds one sandbox pool connection, so at most
+    SANDBOX_POOL_MAX_SIZE run at once. A recommendation already being
+    benchmarked (by this or another request) shares that run.
+    """
+    recommendation_ids = request.get("recommendation_ids")
+    if not recommendation_ids or not isinstance(recommendation_ids, list):
+        raise HTTPException(status_code=400, detail="Missing recommendation_ids")
+    
+    # Each recommendation is benchmarked once, however often it is listed
+    recommendation_ids = list(dict.fromkeys(map(str, recommendation_ids)))
+    recommendations = [_find_recommendation(recommendation_id) for recommendation_id in recommendation_ids]
+    
+    try:
+        benchmark_results = await asyncio.gather(*(
+            _coalesced("benchmark", recommendation_id, lambda rec=recommendation: run_benchmark_test(rec))
+            for recommendation_id, recommendation in zip(recommendation_ids, recommendations)
+        ))
+        return ORJSONResponse({
+            "success": True,
+            "message": f"Benchmark completed for {len(recommendations)} recommendations",
+            "benchmarks": dict(zip(recommendation_ids, benchmark_results))
+        })
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to run benchmarks: {str(e)}")
+
+
 @router.get("/benchmark/{recommendation_id}")
 async def get_benchmark_result(recommendation_id: str) -> Dict[str, Any]:
     """Get benchmark results for a specific recommendation."""
@@ -152,14 +185,14 @@ async def list_all_suggestions() -> Dict[str, Any]:
     recs = get_recommendations_cache()
     if recs is None:
         recs = []
-    
+    categories = dict.fromkeys(SUGGESTION_CATEGORIES, 0)
+    for recommendation_type, count in get_recommendations_type_counts().items():
+        category = RECOMMENDATION_TYPE_CATEGORIES.get(recommendation_type)
+        if category is not None:
+            categories[category] += count
+
     return {
         "total": len(recs),
         "recommendations": recs,
-        "categories": {
-            "index": len([r for r in recs if r.get("type") == "index"]),
-            "query": len([r for r in recs if r.get("type") == "query"]),
-            "schema": len([r for r in recs if r.get("type") == "schema"]),
-            "config": len([r for r in recs if r.get("type") == "config"])
-        }
-    } 
\ No newline at end of file
+        "categories": categories
+    }
@@ -5,10 +5,14 @@ Handles sandbox environment management and benchmark testing.
 
 import asyncio
 import logging
+import re
+import time
 import asyncpg
-from typing import Dict, Any, Optional
-from datetime import datetime
-from config import settings
+import orjson
+from bisect import bisect_right
+from operator import itemgetter
+from typing import Dict, Any, Optional, Tuple
+from datetime import datetime, timezone
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +25,74 @@ SANDBOX_CONFIG = {
     'password': 'sandbox_pass'
 }
 
+class MeasureError(Exception):
+    """A query could not be measured in the sandbox."""
+
+
+# Prefix for the statement that measures a query in the sandbox
+EXPLAIN_ANALYZE_PREFIX = "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) "
+
+# Plain SELECTs, the only queries safe to run an extra time before measuring
+_SELECT_QUERY_RE = re.compile(r'\s*(?:\(\s*)*select\b', re.IGNORECASE)
+
+ADVISORY_ERROR = "No query text provided for this recommendation. This is an advisory recommendation that cannot be automatically benchmarked."
+
+# CREATE/DROP INDEX CONCURRENTLY can't run inside the benchmark transaction;
+# the plain form builds the same index for measurement purposes
+_CONCURRENTLY_RE = re.compile(r'\s+CONCURRENTLY\b', re.IGNORECASE)
+
+# Object names created by a fix, for its rollback SQL (plain or quoted, optionally schema-qualified)
+_IDENT = r'(?:"(?:[^"]|"")+"|[^\s("]+)'
+_CREATE_INDEX_RE = re.compile(
+    rf'\s*create\s+(?:unique\s+)?index\s+(?:concurrently\s+)?(?:if\s+not\s+exists\s+)?({_IDENT})\s+on\s',
+    re.IGNORECASE
+)
+_CREATE_MATVIEW_RE = re.compile(
+    rf'\s*create\s+materialized\s+view\s+(?:if\s+not\s+exists\s+)?({_IDENT}(?:\.{_IDENT})?)',
+    re.IGNORECASE
+)
+
+# Baseline measurements by query text: query -> (monotonic time, metrics).
+# Every benchmark is rolled back, so a baseline stays valid for a while
+# and recommendations for the same query can share it.
+BASELINE_CACHE_TTL = 60
+BASELINE_CACHE_SIZE = 256
+_baseline_cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+# Upper bound on sandbox connections, and so on concurrently running benchmarks
+SANDBOX_POOL_MAX_SIZE = 10
+
+# Shared sandbox connection pool, created on first use
+_pool: Optional[asyncpg.Pool] = None
+_pool_lock = asyncio.Lock()
+
+
+async def get_sandbox_pool() -> asyncpg.Pool:
+    """Get the shared sandbox connection pool, creating it on first use."""
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                try:
+                    _pool = await asyncpg.create_pool(
+                        **SANDBOX_CONFIG,
+                        min_size=2,
+                        max_size=SANDBOX_POOL_MAX_SIZE,
+                        max_inactive_connection_lifetime=300
+                    )
+                except Exception as e:
+                    logger.error("Failed to create sandbox pool: %s", e)
+                    raise
+    return _pool
+
+
+async def close_sandbox_pool():
+    """Close the shared sandbox connection pool, if it was created."""
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        await pool.close()
+
 
 async def get_sandbox_connection() -> asyncpg.Connection:
     """Get connection to sandbox database."""
@@ -28,7 +100,7 @@ async def get_sandbox_connection() -> asyncpg.Connection:
         conn = await asyncpg.connect(**SANDBOX_CONFIG)
         return conn
     except Exception as e:
-        logger.error(f"Failed to connect to sandbox: {e}")
+        logger.error("Failed to connect to sandbox: %s", e)
         raise
 
 
@@ -42,55 +114,44 @@ async def run_benchmark_test(recommendation: Dict[str, Any]) -> Dict[str, Any]:
     Returns:
         Benchmark results with before/after metrics
     """
+    # Advisory recommendations can't be benchmarked; don't touch the sandbox for them
+    if not recommendation.get("query_text"):
+        return {
+            "success": False,
+            "error": ADVISORY_ERROR,
+            "recommendation_id": recommendation.get("id"),
+            "recommendation_type": recommendation.get("recommendation_type", "unknown")
+        }
+    if not recommendation.get("sql_fix"):
+        return {
+            "success": False,
+            "error": "No SQL fix provided for this recommendation, so there is nothing to apply in the sandbox.",
+            "recommendation_id": recommendation.get("id"),
+            "recommendation_type": recommendation.get("recommendation_type", "unknown")
+        }
+    
     try:
-        conn = await get_sandbox_connection()
-        
-        # Step 1: Measure baseline performance
-        baseline_metrics = await measure_query_performance(conn, recommendation)
-        
-        # Check if baseline measurement failed
-        if "error" in baseline_metrics:
-            return {
-                "success": False,
-                "error": baseline_metrics["error"],
-                "recommendation_id": recommendation.get("id"),
-                "recommendation_type": recommendation.get("recommendation_type", "unknown")
-            }
-        
-        # Step 2: Apply the optimization
-        optimization_applied = await apply_optimization(conn, recommendation)
-        
-        if not optimization_applied:
-            return {
-                "success": False,
-                "error": "Failed to apply optimization in sandbox",
-                "baseline": baseline_metrics
-            }
+        pool = await get_sandbox_pool()
+        async with pool.acquire() as conn:
+            # Roll everything back afterwards so the optimization (and any
+            # writes made by EXPLAIN ANALYZE) never persist in the sandbox
+            transaction = conn.transaction()
+            await transaction.start()
+            try:
+                return await _benchmark_in_transaction(conn, recommendation)
+            finally:
+                await transaction.rollback()
         
-        # Step 3: Measure optimized performance
-        optimized_metrics = await measure_query_performance(conn, recommendation)
-        
-        # Step 4: Calculate improvement
-        improvement = calculate_improvement(baseline_metrics, optimized_metrics)
-        
-        # Step 5: Generate rollback SQL
-        rollback_sql = generate_rollback_sql(recommendation)
-        
-        result = {
-            "success": True,
+    except MeasureError as e:
+        logger.error("Performance measurement failed: %s", e, exc_info=True)
+        return {
+            "success": False,
+            "error": str(e),
             "recommendation_id": recommendation.get("id"),
-            "baseline": baseline_metrics,
-            "optimized": optimized_metrics,
-            "improvement": improvement,
-            "rollback_sql": rollback_sql,
-            "tested_at": datetime.utcnow().isoformat()
+            "recommendation_type": recommendation.get("recommendation_type", "unknown")
         }
-        
-        await conn.close()
-        return result
-        
     except Exception as e:
-        logger.error(f"Benchmark test failed: {e}")
+        logger.error("Benchmark test failed: %s", e)
         return {
             "success": False,
             "error": str(e),
@@ -98,37 +159,95 @@ async def run_benchmark_test(recommendation: Dict[str, Any]) -> Dict[str, Any]:
         }
 
 
-async def measure_query_performance(conn: asyncpg.Connection, recommendation: Dict[str, Any]) -> Dict[str, Any]:
-    """Measure query performance in sandbox."""
+async def _benchmark_in_transaction(conn: asyncpg.Connection, recommendation: Dict[str, Any]) -> Dict[str, Any]:
+    """Measure, apply and re-measure a recommendation inside the caller's transaction."""
+    # Step 1: Measure baseline performance (raises MeasureError on failure)
+    baseline_metrics = await measure_baseline_performance(conn, recommendation)
+    
+    # Step 2: Apply the optimization
+    optimization_applied = await apply_optimization(conn, recommendation)
+    
+    if not optimization_applied:
+        return {
+            "success": False,
+            "error": "Failed to apply optimization in sandbox",
+            "baseline": baseline_metrics
+        }
+    
+    # Step 3: Measure optimized performance
+    optimized_metrics = await measure_query_performance(conn, recommendation)
+    
+    # Step 4: Calculate improvement
+    improvement = calculate_improvement(baseline_metrics, optimized_metrics)
+    
+    # Step 5: Generate rollback SQL for the user (the sandbox itself is rolled back)
+    rollback_sql = generate_rollback_sql(recommendation)
+    
+    return {
+        "success": True,
+        "recommendation_id": recommendation.get("id"),
+        "baseline": baseline_metrics,
+        "optimized": optimized_metrics,
+        "improvement": improvement,
+        "rollback_sql": rollback_sql,
+        "tested_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+async def measure_baseline_performance(conn: asyncpg.Connection, recommendation: Dict[str, Any]) -> Dict[str, Any]:
+    """Measure baseline performance, reusing a recent measurement of the same query."""
+    query_text = recommendation.get("query_text", "")
+    now = time.monotonic()
+    cached = _baseline_cache.get(query_text)
+    if cached is not None and now - cached[0] < BASELINE_CACHE_TTL:
+        return dict(cached[1])
+    
+    metrics = await measure_query_performance(conn, recommendation)
+    _baseline_cache.pop(query_text, None)
+    _baseline_cache[query_text] = (now, metrics)
+    if len(_baseline_cache) > BASELINE_CACHE_SIZE:
+        # Oldest measurement first (insertion order)
+        del _baseline_cache[next(iter(_baseline_cache))]
+    return dict(metrics)
+
+
+async def measure_query_performance(conn: asyncpg.Connection, recommendation: Dict[str, Any],
+                                    warmup: bool = True) -> Dict[str, Any]:
+    """
+    Measure query performance in sandbox.
+    
+    Args:
+        conn: Sandbox connection
+        recommendation: The recommendation whose query is measured
+        warmup: Run read-only queries once unmeasured first, so the
+            measurement isn't dominated by cold-cache disk reads
+    
+    Raises:
+        MeasureError: If the recommendation has no query or EXPLAIN ANALYZE fails
+    """
+    query_text = recommendation.get("query_text", "")
+    if not query_text:
+        raise MeasureError(ADVISORY_ERROR)
+    
     try:
-        query_text = recommendation.get("query_text", "")
-        if not query_text:
-            return {"error": "No query text provided for this recommendation. This is an advisory recommendation that cannot be automatically benchmarked."}
-        
-        # Run EXPLAIN ANALYZE to get performance metrics
-        explain_result = await conn.fetchval(
-            "EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + query_text
-        )
+        # Run EXPLAIN ANALYZE to get performance metrics (EXPLAIN takes a
+        # single statement, so drop any trailing terminator)
+        statement = f"{EXPLAIN_ANALYZE_PREFIX}{query_text.rstrip().rstrip(';')}"
+        if warmup and _SELECT_QUERY_RE.match(query_text):
+            # Writes are skipped: a warmup run would change what gets measured
+            await conn.fetchval(statement)
+        explain_result = await conn.fetchval(statement)
+        # asyncpg returns json columns as text unless a codec is registered
+        if isinstance(explain_result, str):
+            explain_result = orjson.loads(explain_result)
         
         # Extract key metrics
         metrics = extract_performance_metrics(explain_result)
-        
-        return {
-            "execution_time": metrics.get("execution_time", 0),
-            "planning_time": metrics.get("planning_time", 0),
-            "total_time": metrics.get("total_time", 0),
-            "rows": metrics.get("rows", 0),
-            "shared_hit_blocks": metrics.get("shared_hit_blocks", 0),
-            "shared_read_blocks": metrics.get("shared_read_blocks", 0),
-            "shared_written_blocks": metrics.get("shared_written_blocks", 0),
-            "temp_read_blocks": metrics.get("temp_read_blocks", 0),
-            "temp_written_blocks": metrics.get("temp_written_blocks", 0),
-            "explain_plan": explain_result
-        }
+        metrics["explain_plan"] = explain_result
+        return metrics
         
     except Exception as e:
-        logger.error(f"Performance measurement failed: {e}")
-        return {"error": str(e)}
+        raise MeasureError(str(e)) from e
 
 
 async def apply_optimization(conn: asyncpg.Connection, recommendation: Dict[str, Any]) -> bool:
@@ -139,11 +258,11 @@ async def apply_optimization(conn: asyncpg.Connection, recommendation: Dict[str,
             return False
         
         # Execute the optimization SQL
-        await conn.execute(sql_fix)
+        await conn.execute(_CONCURRENTLY_RE.sub('', sql_fix))
         return True
         
     except Exception as e:
-        logger.error(f"Failed to apply optimization: {e}")
+        logger.error("Failed to apply optimization: %s", e)
         return False
 
 
@@ -167,65 +286,85 @@ def calculate_improvement(baseline: Dict[str, Any], optimized: Dict[str, Any]) -
         }
         
     except Exception as e:
-        logger.error(f"Improvement calculation failed: {e}")
+        logger.error("Improvement calculation failed: %s", e)
         return {"error": str(e)}
 
 
+# Improvement levels: IMPROVEMENT_LEVELS[i] applies from IMPROVEMENT_THRESHOLDS[i - 1] percent up
+IMPROVEMENT_THRESHOLDS = (1, 10, 25)
+IMPROVEMENT_LEVELS = ("Minimal", "Low", "Medium", "High")
+
+
 def get_improvement_level(improvement_percent: float) -> str:
     """Get improvement level based on percentage."""
-    if improvement_percent >= 25:
-        return "High"
-    elif improvement_percent >= 10:
-        return "Medium"
-    elif improvement_percent >= 1:
-        return "Low"
-    else:
-        return "Minimal"
+    return IMPROVEMENT_LEVELS[bisect_right(IMPROVEMENT_THRESHOLDS, improvement_percent)]
+
+
+# Top-level timings and root plan node counters of an EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) result
+_get_timings = itemgetter("Execution Time", "Planning Time")
+_get_node_counters = itemgetter(
+    "Actual Rows", "Shared Hit Blocks", "Shared Read Blocks", "Shared Written Blocks",
+    "Temp Read Blocks", "Temp Written Blocks"
+)
+
+
+def _empty_performance_metrics() -> Dict[str, Any]:
+    """Performance metrics reported when a plan can't be read."""
+    return {
+        "execution_time": 0,
+        "planning_time": 0,
+        "total_time": 0,
+        "rows": 0,
+        "shared_hit_blocks": 0,
+        "shared_read_blocks": 0,
+        "shared_written_blocks": 0,
+        "temp_read_blocks": 0,
+        "temp_written_blocks": 0
+    }
 
 
 def extract_performance_metrics(explain_result: Any) -> Dict[str, Any]:
-    """Extract performance metrics from EXPLAIN ANALYZE result."""
+    """Extract performance metrics from EXPLAIN ANALYZE result (zeros if unavailable)."""
     try:
         if not explain_result or not isinstance(explain_result, list):
-            return {}
+            return _empty_performance_metrics()
         
-        plan = explain_result[0] if explain_result else {}
+        plan = explain_result[0]
+        execution_time, planning_time = map(float, _get_timings(plan))
+        rows, hit, read, written, temp_read, temp_written = map(int, _get_node_counters(plan["Plan"]))
         
         return {
-            "execution_time": float(plan.get("Execution Time", 0)),
-            "planning_time": float(plan.get("Planning Time", 0)),
-            "total_time": float(plan.get("Execution Time", 0)) + float(plan.get("Planning Time", 0)),
-            "rows": int(plan.get("Actual Rows", 0)),
-            "shared_hit_blocks": int(plan.get("Shared Hit Blocks", 0)),
-            "shared_read_blocks": int(plan.get("Shared Read Blocks", 0)),
-            "shared_written_blocks": int(plan.get("Shared Written Blocks", 0)),
-            "temp_read_blocks": int(plan.get("Temp Read Blocks", 0)),
-            "temp_written_blocks": int(plan.get("Temp Written Blocks", 0))
+            "execution_time": execution_time,
+            "planning_time": planning_time,
+            "total_time": execution_time + planning_time,
+            "rows": rows,
+            "shared_hit_blocks": hit,
+            "shared_read_blocks": read,
+            "shared_written_blocks": written,
+            "temp_read_blocks": temp_read,
+            "temp_written_blocks": temp_written
         }
         
     except Exception as e:
-        logger.error(f"Failed to extract performance metrics: {e}")
-        return {}
+        logger.error("Failed to extract performance metrics: %s", e)
+        return _empty_performance_metrics()
 
 
 def generate_rollback_sql(recommendation: Dict[str, Any]) -> str:
     """Generate rollback SQL for the applied optimization."""
     recommendation_type = recommendation.get("recommendation_type", "")
-    sql_fix = recommendation.get("sql_fix", "")
-    
-    if recommendation_type == "index":
-        # Extract index name from CREATE INDEX statement
-        if "CREATE INDEX" in sql_fix.upper():
-            # Simple extraction - in production, use proper SQL parsing
-            parts = sql_fix.split()
-            if "ON" in parts:
-                on_index = parts.index("ON")
-                if on_index > 0:
-                    index_name = parts[on_index - 1]
-                    return f"DROP INDEX IF EXISTS {index_name};"
-    
-    elif recommendation_type == "config":
+    sql_fix = recommendation.get("sql_fix") or ""
+    
+    match = _CREATE_INDEX_RE.match(sql_fix)
+    if match:
+        return f"DROP INDEX IF EXISTS {match.group(1)};"
+    
+    match = _CREATE_MATVIEW_RE.match(sql_fix)
+    if match:
+        return f"DROP MATERIALIZED VIEW IF EXISTS {match.group(1)};"
+    
+    if recommendation_type == "config":
         # For configuration changes, we'd need to know the original value
         return "-- Configuration rollback requires manual intervention"
     
-    return "-- Rollback SQL not available for this optimization type" 
\ No newline at end of file
+    return "-- Rollback SQL not available for this optimization type"
@@ -0,0 +1,42 @@
+"""
+Shared SQL statements for OptiSchema backend.
+Statements issued from more than one place are defined once here, so every
+caller sends identical text and shares one asyncpg statement cache entry.
+"""
+
+# Connection liveness probe
+SQL_SELECT_1 = "SELECT 1"
+
+# pg_stat_statements availability and enablement, probed in one round-trip
+SQL_EXTENSION_STATUS = """
+SELECT
+    EXISTS(SELECT 1 FROM pg_available_extensions WHERE name = 'pg_stat_statements') AS available,
+    EXISTS(SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements') AS enabled
+"""
+
+# Database info plus the extension status for connection tests
+SQL_TEST_CONNECTION = """
+SELECT
+    version(),
+    current_database(),
+    current_user,
+    EXISTS(SELECT 1 FROM pg_available_extensions WHERE name = 'pg_stat_statements') AS available,
+    EXISTS(SELECT 1 FROM pg_extension WHERE extname = 'pg_stat_statements') AS enabled
+"""
+
+SQL_CREATE_PG_STAT_EXTENSION = "CREATE EXTENSION IF NOT EXISTS pg_stat_statements"
+
+# Whether pg_stat_statements is enabled in the current database
+SQL_PG_STAT_ENABLED = """
+SELECT EXISTS(
+    SELECT 1 FROM pg_extension
+    WHERE extname = 'pg_stat_statements'
+)
+"""
+
+# Number of tracked statements, excluding EXPLAIN/DEALLOCATE noise
+SQL_PG_STAT_COUNT = """
+SELECT COUNT(*) as total_queries
+FROM pg_stat_statements
+WHERE query NOT ILIKE 'EXPLAIN%' AND query NOT ILIKE 'DEALLOCATE%'
+"""
@@ -12,8 +12,9 @@ import os
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from analysis.core import fingerprint_query, identify_hot_queries, detect_basic_issues, analyze_queries
-from analysis.explain import analyze_execution_plan
-from models import QueryMetrics
+from analysis.explain import analyze_execution_plan, extract_plan_metrics, build_execution_plan
+from models import QueryMetrics, AnalysisResult, ExecutionPlan, Recommendation
+from recommendations import generate_recommendations_for_analysis
 from datetime import datetime
 
 
@@ -130,6 +131,124 @@ def test_hot_query_identification():
     print("✅ Hot query identification tests passed!")
 
 
+def test_plan_metrics_extraction():
+    """Test execution plan metrics extraction."""
+    print("\n🧪 Testing Plan Metrics Extraction...")
+    
+    plan_json = [{
+        "Plan": {
+            "Node Type": "Hash Join",
+            "Total Cost": 100.0,
+            "Actual Rows": 10,
+            "Plans": [
+                {
+                    "Node Type": "Seq Scan",
+                    "Relation Name": "orders",
+                    "Total Cost": 60.0,
+                    "Actual Rows": 5000,
+                    "Filter": "(status = 'pending'::text)"
+                },
+                {
+                    "Node Type": "Hash",
+                    "Total Cost": 30.0,
+                    "Actual Rows": 20,
+                    "Plans": [
+                        {"Node Type": "Index Scan", "Total Cost": 10.0, "Actual Rows": 20}
+                    ]
+                }
+            ]
+        },
+        "Planning Time": 0.5,
+        "Execution Time": 12.5
+    }]
+    
+    metrics = extract_plan_metrics(plan_json)
+    
+    print(f"  Total cost: {metrics['total_cost']}, total rows: {metrics['total_rows']}")
+    print(f"  Bottlenecks: {[b['type'] for b in metrics['bottlenecks']]}")
+    
+    assert metrics['total_cost'] == 200.0, "Total cost should sum every node"
+    assert metrics['total_rows'] == 5050, "Total rows should sum every node"
+    assert metrics['total_time'] == 13.0, "Total time should be planning + execution"
+    
+    root = metrics['nodes'][0]
+    assert root['node_type'] == 'Hash Join', "Root node should be first"
+    assert [c['node_type'] for c in root['children']] == ['Seq Scan', 'Hash'], "Child order should be preserved"
+    assert root['children'][1]['children'][0]['depth'] == 2, "Depth should increase per level"
+    assert metrics['node_type_counts']['Seq Scan'] == 1, "Nested nodes should be counted by type"
+    assert sum(metrics['node_type_counts'].values()) == 4, "Every node should be counted once"
+    
+    bottleneck_types = [b['type'] for b in metrics['bottlenecks']]
+    assert 'sequential_scan' in bottleneck_types, "Large sequential scan should be detected"
+    assert 'missing_index' in bottleneck_types, "Filtered sequential scan should be detected"
+    
+    print("✅ Plan metrics extraction tests passed!")
+
+
+def test_execution_plan_round_trip():
+    """Test that an unvalidated ExecutionPlan dumps and re-validates cleanly."""
+    print("\n🧪 Testing Execution Plan Round Trip...")
+    
+    plan_json = [{
+        "Plan": {
+            "Node Type": "Sort",
+            "Total Cost": 50.0,
+            "Actual Rows": 20000,
+            "Plans": [
+                {"Node Type": "Seq Scan", "Relation Name": "users", "Total Cost": 40.0, "Actual Rows": 20000}
+            ]
+        },
+        "Planning Time": 0.2,
+        "Execution Time": 30.0
+    }]
+    
+    execution_plan = build_execution_plan(plan_json)
+    analysis = AnalysisResult.model_construct(
+        query_hash="hash1",
+        query_text="SELECT * FROM users ORDER BY name",
+        execution_plan=execution_plan,
+        created_at=datetime.utcnow()
+    )
+    
+    dumped = analysis.model_dump()
+    print(f"  Bottlenecks: {[b['type'] for b in dumped['execution_plan']['bottlenecks']]}")
+    assert dumped['execution_plan']['plan_json'] == plan_json, "Raw plan should survive the dump unchanged"
+    assert dumped['execution_plan']['execution_time'] == 30.0, "Plan timings should be kept"
+    
+    restored = AnalysisResult.model_validate(dumped)
+    assert restored.execution_plan == execution_plan, "Dumped plan should validate back to the same plan"
+    
+    print("✅ Execution plan round trip tests passed!")
+
+
+async def test_recommendation_fields_populated():
+    """Test that recommendations built without validation still carry every required field."""
+    print("\n🧪 Testing Recommendation Construction...")
+    
+    # A clean, fast plan lets the AI recommendation short-circuit without an API call
+    analysis = AnalysisResult(
+        query_hash="hash1",
+        query_text="SELECT * FROM users WHERE email = 'a@example.com'",
+        execution_plan=ExecutionPlan(plan_json={}, execution_time=1.0),
+        performance_score=40,
+        bottleneck_type="missing_index"
+    )
+    
+    recs = await generate_recommendations_for_analysis(analysis)
+    
+    print(f"  Recommendations: {[r.recommendation_type for r in recs]}")
+    assert [r.recommendation_type for r in recs] == ["index", "ai"], "Heuristic and AI recommendations expected"
+    
+    required = [name for name, field in Recommendation.model_fields.items() if field.is_required()]
+    for rec in recs:
+        missing = [name for name in required if name not in rec.__dict__]
+        assert not missing, f"Recommendation is missing required fields: {missing}"
+        # Constructed values must still satisfy the model's own validation
+        Recommendation.model_validate(rec.model_dump())
+    
+    print("✅ Recommendation construction tests passed!")
+
+
 async def test_analysis_pipeline():
     """Test the complete analysis pipeline."""
     print("\n🧪 Testing Analysis Pipeline...")
@@ -177,8 +296,11 @@ async def main():
         test_query_fingerprinting()
         test_basic_issues_detection()
         test_hot_query_identification()
+        test_plan_metrics_extraction()
+        test_execution_plan_round_trip()
         
         # Run asynchronous tests
+        await test_recommendation_fields_populated()
         await test_analysis_pipeline()
         
         print("\n🎉 All tests passed! Analysis engine is working correctly.")
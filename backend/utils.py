@@ -3,11 +3,21 @@ Utility functions for OptiSchema backend.
 """
 
 import logging
+import numpy as np
+import xxhash
 from typing import Any, Optional
 
 logger = logging.getLogger(__name__)
 
 
+def query_hash(query_text: str) -> str:
+    """
+    Stable hash of a query's text, used as QueryMetrics.query_hash.
+    Unlike hash(), the value is the same across processes and restarts.
+    """
+    return xxhash.xxh3_64_hexdigest(query_text.encode('utf-8'))
+
+
 def calculate_performance_score(hot_query: Any, execution_plan: Optional[Any] = None) -> int:
     """
     Calculate a unified performance score (0-100) for the query.
@@ -61,7 +71,53 @@ def calculate_performance_score(hot_query: Any, execution_plan: Optional[Any] =
         except Exception as e:
             logger.warning(f"Failed to analyze execution plan for performance score: {e}")
     
-    return max(0, min(100, score))
+    return round(max(0, min(100, score)))
+
+
+def calculate_performance_score_vec(mean_time: np.ndarray, calls: np.ndarray, pct: np.ndarray,
+                                   hit: np.ndarray, read: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    """
+    Vectorized calculate_performance_score for a batch of queries (no execution plan).
+    
+    Args:
+        mean_time: Mean execution times (ms)
+        calls: Call counts
+        pct: Percentages of total execution time
+        hit: Shared blocks hit
+        read: Shared blocks read
+        rows: Rows returned
+        
+    Returns:
+        Rounded performance scores (0-100) as an int64 array
+    """
+    mean_time = np.asarray(mean_time, dtype=np.float64)
+    calls = np.asarray(calls, dtype=np.float64)
+    pct = np.asarray(pct, dtype=np.float64)
+    hit = np.asarray(hit, dtype=np.float64)
+    read = np.asarray(read, dtype=np.float64)
+    rows = np.asarray(rows, dtype=np.float64)
+    
+    score = np.full(mean_time.shape, 100.0)
+    
+    # Penalize based on execution time
+    score -= np.where(mean_time > 10, np.minimum(40, (mean_time - 10) / 2), 0)
+    
+    # Penalize based on frequency
+    score -= np.where(calls > 1000, 20, np.where(calls > 100, 10, 0))
+    
+    # Penalize based on percentage of total time
+    score -= np.where(pct > 10, np.minimum(20, (pct - 10) * 0.5), 0)
+    
+    # Penalize low cache hit rate, and give a bonus for efficient row processing
+    total_blocks = hit + read
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cache_hit = np.where(total_blocks > 0, hit / total_blocks * 100, 100)
+        row_efficiency = np.minimum(100, (rows / (read * 8192 / 100)) * 100)
+    score -= np.where(cache_hit < 95, (95 - cache_hit) * 0.5, 0)
+    row_efficiency = np.where((rows > 0) & (read > 0), row_efficiency, 0)
+    score += np.where(row_efficiency > 80, np.minimum(10, (row_efficiency - 80) * 0.2), 0)
+    
+    return np.rint(np.clip(score, 0, 100)).astype(np.int64)
 
 
 def get_plan_summary(execution_plan: Any) -> dict:
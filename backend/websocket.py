@@ -4,35 +4,103 @@ Handles real-time communication for live dashboard updates.
 """
 
 import asyncio
+import itertools
 import logging
 import time
-from datetime import datetime
-from typing import Dict, Set, Any
+import orjson
+from collections import deque
+from functools import partial
+from datetime import datetime, timezone
+from typing import Deque, Dict, List, Set, Tuple, Any, Optional
 from fastapi import WebSocket, WebSocketDisconnect
+from config import get_settings
 from models import WebSocketMessage
 
 logger = logging.getLogger(__name__)
 
-# Global WebSocket connection management
-websocket_connections: Dict[str, WebSocket] = {}
-subscriptions: Dict[str, Set[str]] = {}  # connection_id -> set of subscription types
+# Payload timestamp shared by messages sent within TIMESTAMP_RESOLUTION
+# seconds of each other: (ISO string, time.time() it was taken)
+TIMESTAMP_RESOLUTION = 0.05
+_timestamp_cache = ("", 0.0)
+
+
+def now_iso() -> str:
+    """Current UTC time as a naive ISO string (same format as datetime.utcnow().isoformat())."""
+    global _timestamp_cache
+    now = time.time()
+    if now - _timestamp_cache[1] >= TIMESTAMP_RESOLUTION:
+        formatted = datetime.fromtimestamp(now, timezone.utc).replace(tzinfo=None).isoformat()
+        _timestamp_cache = (formatted, now)
+    return _timestamp_cache[0]
+
+
+# Seconds a single send may take before the client is treated as stuck
+SEND_TIMEOUT = 2.0
+# Frames that may wait for a slow client before it is dropped
+SEND_QUEUE_SIZE = 64
+# Recent send latencies kept per connection
+SEND_LATENCY_SAMPLES = 64
+
+# Subscription type -> bit in a connection's subscription mask
+SUBSCRIPTION_BITS = {
+    "metrics": 1,
+    "recommendations": 2,
+    "analysis": 4,
+}
+
+# Connection ID sequence (restarts from 1 with the process)
+_connection_ids = itertools.count(1)
+
+
+def _message(message_type: str, data: Dict[str, Any]) -> Dict[str, Any]:
+    """A server-built message as the dict WebSocketMessage would serialize to."""
+    return {"type": message_type, "data": data, "timestamp": now_iso()}
+
+
+def _encode_message(message: Dict[str, Any]) -> str:
+    """Encode a message dict for a text frame."""
+    return orjson.dumps(message, default=str).decode()
+
+
+# Encoded size of the last broadcast message of each type
+_encoded_sizes: Dict[str, int] = {}
+
+
+async def _encode_broadcast(message: Dict[str, Any]) -> str:
+    """Encode a broadcast message, in a worker thread if its type was large last time."""
+    message_type = message["type"]
+    if _encoded_sizes.get(message_type, 0) >= get_settings().ws_offload_encode_bytes:
+        message_json = await asyncio.to_thread(_encode_message, message)
+    else:
+        message_json = _encode_message(message)
+    _encoded_sizes[message_type] = len(message_json)
+    return message_json
 
 
 class WebSocketManager:
     """Manages WebSocket connections and subscriptions."""
     
     def __init__(self):
-        self.connections = websocket_connections
-        self.subscriptions = subscriptions
+        self.connections: Dict[str, WebSocket] = {}
+        self.subscriptions: Dict[str, int] = {}  # connection_id -> mask of SUBSCRIPTION_BITS
+        self.subscribers: Dict[str, Set[str]] = {}  # subscription type -> set of connection_ids
+        self.send_queues: Dict[str, asyncio.Queue] = {}  # connection_id -> frames waiting to be sent
+        self.writers: Dict[str, asyncio.Task] = {}  # connection_id -> task draining its send queue
+        self.send_latencies: Dict[str, Deque[float]] = {}  # connection_id -> recent send durations (s)
+        self.total_subscriptions = 0  # set bits across all subscription masks
     
     async def connect(self, websocket: WebSocket) -> str:
         """Accept a new WebSocket connection."""
         await websocket.accept()
         
-        # Generate unique connection ID
-        connection_id = f"ws_{int(time.time() * 1000)}_{id(websocket)}"
+        # Short sequential ID; unique within this process only
+        connection_id = f"ws_{next(_connection_ids)}"
         self.connections[connection_id] = websocket
-        self.subscriptions[connection_id] = set()
+        self.subscriptions[connection_id] = 0
+        self.send_latencies[connection_id] = deque(maxlen=SEND_LATENCY_SAMPLES)
+        queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        self.send_queues[connection_id] = queue
+        self.writers[connection_id] = asyncio.create_task(self._writer(connection_id, websocket, queue))
         
         logger.info(f"WebSocket connection established: {connection_id}")
         return connection_id
@@ -41,54 +109,144 @@ class WebSocketManager:
         """Remove a WebSocket connection."""
         if connection_id in self.connections:
             del self.connections[connection_id]
-        if connection_id in self.subscriptions:
-            del self.subscriptions[connection_id]
+        self.send_latencies.pop(connection_id, None)
+        self.send_queues.pop(connection_id, None)
+        writer = self.writers.pop(connection_id, None)
+        if writer is not None and writer is not asyncio.current_task():
+            writer.cancel()
+        mask = self.subscriptions.pop(connection_id, 0)
+        self.total_subscriptions -= mask.bit_count()
+        for subscription_type, bit in SUBSCRIPTION_BITS.items():
+            if mask & bit:
+                self.subscribers.get(subscription_type, set()).discard(connection_id)
         logger.info(f"WebSocket connection removed: {connection_id}")
     
     async def send_message(self, connection_id: str, message: WebSocketMessage):
         """Send a message to a specific connection."""
-        if connection_id in self.connections:
-            try:
-                websocket = self.connections[connection_id]
-                await websocket.send_text(message.model_dump_json())
-            except Exception as e:
-                logger.error(f"Failed to send message to {connection_id}: {e}")
-                self.disconnect(connection_id)
+        await self._send_all([connection_id], message.model_dump_json())
     
     async def broadcast(self, message: WebSocketMessage, subscription_type: str = None):
         """Broadcast a message to all connections (optionally filtered by subscription)."""
         if not self.connections:
             return
+        if subscription_type and not self.has_subscribers(subscription_type):
+            return
         
+        # Encode once for every recipient; sent as text since clients JSON.parse frames
         message_json = message.model_dump_json()
-        disconnected = []
         
-        for connection_id, websocket in self.connections.items():
+        # If subscription type is specified, only send to its subscribers
+        if subscription_type:
+            connection_ids = list(self.subscribers.get(subscription_type, ()))
+        else:
+            connection_ids = list(self.connections)
+        
+        await self._send_all(connection_ids, message_json)
+    
+    async def broadcast_bundle(self, messages: List[Tuple[Optional[str], Dict[str, Any]]]):
+        """
+        Broadcast several (subscription type, message) pairs at once.
+        Messages are plain dicts in the WebSocketMessage shape.
+        
+        Each connection receives the messages it is subscribed to in a single
+        "batch" frame (or the bare message if only one applies). Connections
+        with the same subscriptions share one encoded payload.
+        """
+        if not self.connections:
+            return
+        
+        # Subscription mask -> connection_ids with that mask
+        groups: Dict[int, List[str]] = {}
+        for connection_id, mask in self.subscriptions.items():
+            groups.setdefault(mask, []).append(connection_id)
+        
+        # Messages without a subscription type have bit 0 and go to everyone
+        bits = [SUBSCRIPTION_BITS.get(subscription_type, 0) for subscription_type, _ in messages]
+        sends = []
+        for mask, connection_ids in groups.items():
+            selected = [index for index, bit in enumerate(bits) if not bit or mask & bit]
+            if not selected:
+                continue
+            if len(selected) == 1:
+                message = messages[selected[0]][1]
+            else:
+                message = _message(
+                    "batch",
+                    {
+                        "timestamp": now_iso(),
+                        "items": [messages[index][1] for index in selected]
+                    }
+                )
+            sends.append(self._send_all(connection_ids, await _encode_broadcast(message)))
+        await asyncio.gather(*sends)
+    
+    async def _send_all(self, connection_ids: List[str], message_json: str):
+        """Queue an encoded message for the given connections, dropping any that can't keep up."""
+        overflowed = []
+        for connection_id in connection_ids:
+            queue = self.send_queues.get(connection_id)
+            if queue is None:
+                continue
             try:
-                # If subscription type is specified, only send to subscribed connections
-                if subscription_type and connection_id in self.subscriptions:
-                    if subscription_type not in self.subscriptions[connection_id]:
-                        continue
-                
-                await websocket.send_text(message_json)
-            except Exception as e:
-                logger.error(f"Failed to broadcast to {connection_id}: {e}")
-                disconnected.append(connection_id)
+                queue.put_nowait(message_json)
+            except asyncio.QueueFull:
+                logger.error(f"Send queue full for {connection_id}, dropping connection")
+                overflowed.append(connection_id)
         
-        # Clean up disconnected connections
-        for connection_id in disconnected:
-            self.disconnect(connection_id)
+        if overflowed:
+            await asyncio.gather(*(self._drop(connection_id, close=True) for connection_id in overflowed))
+    
+    async def _writer(self, connection_id: str, websocket: WebSocket, queue: asyncio.Queue):
+        """Send a connection's queued frames in order until a send fails."""
+        while True:
+            message_json = await queue.get()
+            try:
+                await self._send(connection_id, websocket, message_json)
+            except Exception as e:
+                logger.error(f"Failed to send message to {connection_id}: {e!r}")
+                await self._drop(connection_id, close=isinstance(e, asyncio.TimeoutError))
+                return
+    
+    async def _send(self, connection_id: str, websocket: WebSocket, message_json: str):
+        """Send one frame, failing with TimeoutError if the client stalls past SEND_TIMEOUT."""
+        started = time.perf_counter()
+        await asyncio.wait_for(websocket.send_text(message_json), timeout=SEND_TIMEOUT)
+        latencies = self.send_latencies.get(connection_id)
+        if latencies is not None:
+            latencies.append(time.perf_counter() - started)
+    
+    async def _drop(self, connection_id: str, close: bool = False):
+        """Forget a failed connection, closing it first if it is stuck rather than gone."""
+        websocket = self.connections.get(connection_id)
+        self.disconnect(connection_id)
+        if close and websocket is not None:
+            try:
+                await asyncio.wait_for(websocket.close(code=1011), timeout=SEND_TIMEOUT)
+            except Exception:
+                pass
+    
+    def has_subscribers(self, subscription_type: str) -> bool:
+        """Whether any connection is subscribed to a type of updates."""
+        return bool(self.subscribers.get(subscription_type))
     
     def subscribe(self, connection_id: str, subscription_type: str):
         """Subscribe a connection to a specific type of updates."""
         if connection_id in self.subscriptions:
-            self.subscriptions[connection_id].add(subscription_type)
+            bit = SUBSCRIPTION_BITS[subscription_type]
+            if not self.subscriptions[connection_id] & bit:
+                self.subscriptions[connection_id] |= bit
+                self.total_subscriptions += 1
+            self.subscribers.setdefault(subscription_type, set()).add(connection_id)
             logger.info(f"Connection {connection_id} subscribed to {subscription_type}")
     
     def unsubscribe(self, connection_id: str, subscription_type: str):
         """Unsubscribe a connection from a specific type of updates."""
         if connection_id in self.subscriptions:
-            self.subscriptions[connection_id].discard(subscription_type)
+            bit = SUBSCRIPTION_BITS.get(subscription_type, 0)
+            if self.subscriptions[connection_id] & bit:
+                self.subscriptions[connection_id] &= ~bit
+                self.total_subscriptions -= 1
+            self.subscribers.get(subscription_type, set()).discard(connection_id)
             logger.info(f"Connection {connection_id} unsubscribed from {subscription_type}")
 
 
@@ -102,12 +260,12 @@ async def handle_websocket_connection(websocket: WebSocket):
     
     try:
         # Send welcome message
-        welcome_message = WebSocketMessage(
+        welcome_message = WebSocketMessage.model_construct(
             type="connection_established",
             data={
                 "connection_id": connection_id,
                 "message": "Connected to OptiSchema WebSocket",
-                "timestamp": datetime.utcnow().isoformat()
+                "timestamp": now_iso()
             }
         )
         await ws_manager.send_message(connection_id, welcome_message)
@@ -133,75 +291,76 @@ async def handle_websocket_connection(websocket: WebSocket):
         ws_manager.disconnect(connection_id)
 
 
+async def _handle_ping(connection_id: str, data: Dict[str, Any]):
+    """Answer a ping with a pong."""
+    response = WebSocketMessage.model_construct(
+        type="pong",
+        data={
+            "timestamp": now_iso(),
+            "connection_id": connection_id
+        }
+    )
+    await ws_manager.send_message(connection_id, response)
+
+
+async def _handle_subscribe(subscription_type: str, connection_id: str, data: Dict[str, Any]):
+    """Subscribe the connection to a type of updates and confirm it."""
+    ws_manager.subscribe(connection_id, subscription_type)
+    response = WebSocketMessage.model_construct(
+        type="subscription_confirmed",
+        data={
+            "subscription": subscription_type,
+            "connection_id": connection_id
+        }
+    )
+    await ws_manager.send_message(connection_id, response)
+
+
+async def _handle_unsubscribe(connection_id: str, data: Dict[str, Any]):
+    """Unsubscribe the connection from the requested type of updates and confirm it."""
+    subscription_type = data.get("subscription_type")
+    if subscription_type:
+        ws_manager.unsubscribe(connection_id, subscription_type)
+        response = WebSocketMessage.model_construct(
+            type="unsubscription_confirmed",
+            data={
+                "subscription": subscription_type,
+                "connection_id": connection_id
+            }
+        )
+        await ws_manager.send_message(connection_id, response)
+
+
+# Inbound message type -> handler(connection_id, message data)
+MESSAGE_HANDLERS = {
+    "ping": _handle_ping,
+    "subscribe_metrics": partial(_handle_subscribe, "metrics"),
+    "subscribe_recommendations": partial(_handle_subscribe, "recommendations"),
+    "subscribe_analysis": partial(_handle_subscribe, "analysis"),
+    "unsubscribe": _handle_unsubscribe,
+}
+
+
 async def handle_websocket_message(connection_id: str, data: str):
     """Handle incoming WebSocket messages."""
     try:
-        message = WebSocketMessage.model_validate_json(data)
-        logger.info(f"Received WebSocket message from {connection_id}: {message.type}")
-        
-        # Handle different message types
-        if message.type == "ping":
-            response = WebSocketMessage(
-                type="pong",
-                data={
-                    "timestamp": datetime.utcnow().isoformat(),
-                    "connection_id": connection_id
-                }
-            )
-            await ws_manager.send_message(connection_id, response)
-        
-        elif message.type == "subscribe_metrics":
-            ws_manager.subscribe(connection_id, "metrics")
-            response = WebSocketMessage(
-                type="subscription_confirmed",
-                data={
-                    "subscription": "metrics",
-                    "connection_id": connection_id
-                }
-            )
-            await ws_manager.send_message(connection_id, response)
-        
-        elif message.type == "subscribe_recommendations":
-            ws_manager.subscribe(connection_id, "recommendations")
-            response = WebSocketMessage(
-                type="subscription_confirmed",
-                data={
-                    "subscription": "recommendations",
-                    "connection_id": connection_id
-                }
-            )
-            await ws_manager.send_message(connection_id, response)
-        
-        elif message.type == "subscribe_analysis":
-            ws_manager.subscribe(connection_id, "analysis")
-            response = WebSocketMessage(
-                type="subscription_confirmed",
-                data={
-                    "subscription": "analysis",
-                    "connection_id": connection_id
-                }
-            )
-            await ws_manager.send_message(connection_id, response)
-        
-        elif message.type == "unsubscribe":
-            subscription_type = message.data.get("subscription_type")
-            if subscription_type:
-                ws_manager.unsubscribe(connection_id, subscription_type)
-                response = WebSocketMessage(
-                    type="unsubscription_confirmed",
-                    data={
-                        "subscription": subscription_type,
-                        "connection_id": connection_id
-                    }
-                )
-                await ws_manager.send_message(connection_id, response)
+        # Only type and data are used, so check those two instead of
+        # validating the whole WebSocketMessage
+        message = orjson.loads(data)
+        message_type, message_data = message["type"], message["data"]
+        if not isinstance(message_type, str) or not isinstance(message_data, dict):
+            raise ValueError("Message type must be a string and data an object")
+        logger.info(f"Received WebSocket message from {connection_id}: {message_type}")
         
+        handler = MESSAGE_HANDLERS.get(message_type)
+        if handler is not None:
+            await handler(connection_id, message_data)
         else:
             # Unknown message type
-            response = WebSocketMessage(
+            response = WebSocketMessage.model_construct(
                 type="error",
                 data={
-                    "error": f"Unknown message type: {message.type}",
+                    "error": f"Unknown message type: {message_type}",
                     "connection_id": connection_id
                 }
             )
@@ -209,7 +368,7 @@ async def handle_websocket_message(connection_id: str, data: str):
     
     except Exception as e:
         logger.error(f"Error processing WebSocket message from {connection_id}: {e}")
-        error_message = WebSocketMessage(
+        error_message = WebSocketMessage.model_construct(
             type="error",
             data={
                 "error": "Invalid message format",
@@ -219,71 +378,121 @@ async def handle_websocket_message(connection_id: str, data: str):
         await ws_manager.send_message(connection_id, error_message)
 
 
-# Real-time update functions
+# Updates waiting to be broadcast as (subscription type, message) pairs; a
+# subscription type of None goes to every client. A single flusher task sends
+# the queue at most once per BROADCAST_INTERVAL seconds, so each client gets
+# one frame per flush however many updates it subscribes to. Metrics updates
+# replace any still-pending one, so bursts collapse into the most recent.
+BROADCAST_INTERVAL = 0.05
+_pending_updates: List[Tuple[Optional[str], Dict[str, Any]]] = []
+_update_flusher: Optional[asyncio.Task] = None
+
+
+def _queue_update(subscription_type: Optional[str], message: Dict[str, Any], replace: bool = False):
+    """Queue a message for the next flush, starting the flusher if it is idle."""
+    global _update_flusher
+    if replace:
+        _pending_updates[:] = [
+            pending for pending in _pending_updates
+            if pending[1]["type"] != message["type"]
+        ]
+    _pending_updates.append((subscription_type, message))
+    if _update_flusher is None or _update_flusher.done():
+        _update_flusher = asyncio.create_task(_flush_updates())
+
+
+async def _flush_updates():
+    """Send queued updates until none arrive within a broadcast interval."""
+    while _pending_updates:
+        messages = _pending_updates[:]
+        _pending_updates.clear()
+        await ws_manager.broadcast_bundle(messages)
+        await asyncio.sleep(BROADCAST_INTERVAL)
+
+
+# Real-time update functions (messages are built from server data, so they
+# skip WebSocketMessage and are encoded straight from dicts)
 async def broadcast_metrics_update(metrics_data: Dict[str, Any]):
-    """Broadcast metrics update to subscribed clients."""
-    message = WebSocketMessage(
-        type="metrics_update",
-        data={
-            "timestamp": datetime.utcnow().isoformat(),
+    """Broadcast metrics update to subscribed clients (coalesced with other pending updates)."""
+    if not ws_manager.has_subscribers("metrics"):
+        return
+    message = _message(
+        "metrics_update",
+        {
+            "timestamp": now_iso(),
             "metrics": metrics_data
         }
     )
-    await ws_manager.broadcast(message, "metrics")
+    _queue_update("metrics", message, replace=True)
 
 
 async def broadcast_recommendation_update(recommendation_data: Dict[str, Any]):
     """Broadcast recommendation update to subscribed clients."""
-    message = WebSocketMessage(
-        type="recommendation_update",
-        data={
-            "timestamp": datetime.utcnow().isoformat(),
+    if not ws_manager.has_subscribers("recommendations"):
+        return
+    message = _message(
+        "recommendation_update",
+        {
+            "timestamp": now_iso(),
             "recommendation": recommendation_data
         }
     )
-    await ws_manager.broadcast(message, "recommendations")
+    _queue_update("recommendations", message)
 
 
 async def broadcast_analysis_update(analysis_data: Dict[str, Any]):
     """Broadcast analysis update to subscribed clients."""
-    message = WebSocketMessage(
-        type="analysis_update",
-        data={
-            "timestamp": datetime.utcnow().isoformat(),
+    if not ws_manager.has_subscribers("analysis"):
+        return
+    message = _message(
+        "analysis_update",
+        {
+            "timestamp": now_iso(),
             "analysis": analysis_data
         }
     )
-    await ws_manager.broadcast(message, "analysis")
+    _queue_update("analysis", message)
 
 
 async def broadcast_system_status(status_data: Dict[str, Any]):
     """Broadcast system status update to all clients."""
-    message = WebSocketMessage(
-        type="system_status",
-        data={
-            "timestamp": datetime.utcnow().isoformat(),
+    if not ws_manager.connections:
+        return
+    message = _message(
+        "system_status",
+        {
+            "timestamp": now_iso(),
             "status": status_data
         }
     )
-    await ws_manager.broadcast(message)
+    _queue_update(None, message)
 
 
 # Background task for periodic updates
+STATUS_UPDATE_INTERVAL = 30  # seconds
+START_TIME = time.monotonic()
+
+
 async def periodic_updates_task():
     """Background task that sends periodic updates to WebSocket clients."""
+    # Ticks are scheduled from a fixed start so slow iterations don't accumulate drift
+    next_tick = time.monotonic()
     while True:
         try:
-            # Send system status every 30 seconds
             status_data = {
                 "active_connections": len(ws_manager.connections),
-                "total_subscriptions": sum(len(subs) for subs in ws_manager.subscriptions.values()),
-                "uptime": time.time() - time.time()  # TODO: Get actual uptime
+                "total_subscriptions": ws_manager.total_subscriptions,
+                "uptime": time.monotonic() - START_TIME
             }
             await broadcast_system_status(status_data)
             
-            # Wait 30 seconds before next update
-            await asyncio.sleep(30)
-            
         except Exception as e:
             logger.error(f"Error in periodic updates task: {e}")
-            await asyncio.sleep(30)  # Continue even if there's an error 
\ No newline at end of file
+        
+        # Continue on the next tick even if there was an error, skipping any
+        # ticks already missed
+        now = time.monotonic()
+        next_tick += STATUS_UPDATE_INTERVAL
+        if next_tick < now:
+            next_tick = now
+        await asyncio.sleep(next_tick - now)
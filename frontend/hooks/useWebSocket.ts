@@ -35,9 +35,14 @@ export function useWebSocket({
 
       ws.onmessage = (event) => {
         try {
-          const message: WebSocketMessage = JSON.parse(event.data)
-          setLastMessage(message)
-          onMessage?.(message)
+          const message = JSON.parse(event.data)
+          // The server packs updates sent together into one "batch" frame
+          const messages: WebSocketMessage[] =
+            message.type === 'batch' ? message.data.items : [message]
+          messages.forEach((item) => {
+            setLastMessage(item)
+            onMessage?.(item)
+          })
         } catch (error) {
           console.error('Failed to parse WebSocket message:', error)
         }